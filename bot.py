@@ -4,13 +4,20 @@ import json
 import re
 import io
 import time
+import random
 import pandas as pd
 import requests
 import threading
 import asyncio
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from mattermostdriver import Driver
 import jinja2
+import jira_users
+import storage
+import http_session
+import tempo_stream
 
 # --- ИМПОРТ МОДУЛЯ TEAMS ---
 try:
@@ -41,9 +48,67 @@ VERIFY_SSL = get_env("VERIFY_SSL", "False").lower() in ('true', '1', 't')
 if not VERIFY_SSL:
     requests.packages.urllib3.disable_warnings()
 
-# Глобальные кэши
-JIRA_LOOKUP_CACHE = {}
-JIRA_KEY_CACHE = {}
+# Совпадения ФИО с уверенностью ниже порога помечаются в отчете для ручной проверки
+MATCH_LOW_CONFIDENCE = float(get_env("MATCH_LOW_CONFIDENCE", "0.85"))
+
+# Глобальный справочник пользователей Jira (общий для всех задач, только чтение)
+JIRA_DIRECTORY = jira_users.UserDirectory()
+# Снимок справочника на диске: бот стартует с него, не дожидаясь загрузки из Jira
+JIRA_SNAPSHOT_PATH = get_env("JIRA_SNAPSHOT_PATH", "data/jira_users.snapshot")
+# Период фонового обновления справочника (минуты, 0 — не обновлять)
+JIRA_USERS_REFRESH_MINUTES = float(get_env("JIRA_USERS_REFRESH_MINUTES", "60"))
+# Справочник, уменьшившийся при обновлении больше чем на столько процентов, не публикуется
+JIRA_USERS_MAX_DROP_PERCENT = float(get_env("JIRA_USERS_MAX_DROP_PERCENT", "20"))
+_REFRESH_LOCK = threading.Lock()
+# Способ загрузки справочника: "search" (широкие маски по очереди), "sharded" (префиксы параллельно)
+# или "groups" (только участники групп JIRA_USER_GROUPS)
+JIRA_USERS_LOAD_MODE = get_env("JIRA_USERS_LOAD_MODE", "search").lower()
+JIRA_USERS_FETCH_WORKERS = int(get_env("JIRA_USERS_FETCH_WORKERS", "8"))
+JIRA_USERS_SHARD_LIMIT = int(get_env("JIRA_USERS_SHARD_LIMIT", "1000"))
+JIRA_USER_GROUPS = [g.strip() for g in get_env("JIRA_USER_GROUPS", "").split(",") if g.strip()]
+USER_SHARD_LATIN = "abcdefghijklmnopqrstuvwxyz"
+USER_SHARD_CYRILLIC = "абвгдеёжзийклмнопрстуфхцчшщэюя"
+USER_SHARD_PREFIXES = list(USER_SHARD_LATIN) + list(USER_SHARD_CYRILLIC) + list("0123456789")
+USER_SHARD_MAX_DEPTH = 3
+# Точечный поиск в Jira сотрудников, которых нет в справочнике (например, принятых после запуска)
+JIRA_LOOKUP_WORKERS = int(get_env("JIRA_LOOKUP_WORKERS", "4"))
+JIRA_LOOKUP_CACHE_SIZE = int(get_env("JIRA_LOOKUP_CACHE_SIZE", "2000"))
+JIRA_LOOKUP_TTL_MINUTES = float(get_env("JIRA_LOOKUP_TTL_MINUTES", "60"))
+JIRA_LOOKUP_NEGATIVE_TTL_MINUTES = float(get_env("JIRA_LOOKUP_NEGATIVE_TTL_MINUTES", "15"))
+# Параллельных запросов ворклогов Tempo (по пачке сотрудников на запрос)
+TEMPO_FETCH_WORKERS = int(get_env("TEMPO_FETCH_WORKERS", "4"))
+# Параллельных запросов составов команд Tempo
+TEMPO_TEAMS_FETCH_WORKERS = int(get_env("TEMPO_TEAMS_FETCH_WORKERS", "8"))
+# Сколько минут снимок составов команд за период используется без обращения к Tempo
+# (снимки закрытых периодов используются всегда)
+TEMPO_TEAMS_TTL_MINUTES = float(get_env("TEMPO_TEAMS_TTL_MINUTES", "360"))
+# Размер пачки подбирается на ходу: начальный (или сохраненный с прошлого запуска), предел,
+# целевое время ответа, предельный размер ответа и таймаут запроса
+TEMPO_CHUNK_SIZE = int(get_env("TEMPO_CHUNK_SIZE", "25"))
+TEMPO_CHUNK_MAX = int(get_env("TEMPO_CHUNK_MAX", "100"))
+TEMPO_CHUNK_TARGET_SECONDS = float(get_env("TEMPO_CHUNK_TARGET_SECONDS", "15"))
+TEMPO_CHUNK_MAX_BYTES = int(float(get_env("TEMPO_CHUNK_MAX_MB", "20")) * 1024 * 1024)
+TEMPO_CHUNK_TIMEOUT = float(get_env("TEMPO_CHUNK_TIMEOUT", "90"))
+# Повторы неудачного запроса с экспоненциальной задержкой (секунды: base, 2*base, 4*base... со случайным разбросом)
+TEMPO_RETRIES = int(get_env("TEMPO_RETRIES", "3"))
+TEMPO_BACKOFF_SECONDS = float(get_env("TEMPO_BACKOFF_SECONDS", "1"))
+# После стольких ошибок подряд Tempo считается недоступным и не запрашивается TEMPO_BREAKER_COOLDOWN секунд
+TEMPO_BREAKER_THRESHOLD = int(get_env("TEMPO_BREAKER_THRESHOLD", "5"))
+TEMPO_BREAKER_COOLDOWN = float(get_env("TEMPO_BREAKER_COOLDOWN", "60"))
+# Период запроса делится на окна по столько дней (0 — весь период одним окном)
+TEMPO_WINDOW_DAYS = int(get_env("TEMPO_WINDOW_DAYS", "7"))
+# Способ загрузки ворклогов: auto (по оценке стоимости), workers, teams или scan; цена одного
+# запроса в оценке — сколько сотруднико-дней ворклогов можно получить за время одного запроса
+TEMPO_FETCH_PLAN = get_env("TEMPO_FETCH_PLAN", "auto").lower()
+TEMPO_PLAN_REQUEST_COST = float(get_env("TEMPO_PLAN_REQUEST_COST", "200"))
+# Разбирать ответы Tempo потоком (по одному ворклогу), не загружая весь ответ в память
+TEMPO_STREAM_PARSE = get_env("TEMPO_STREAM_PARSE", "False").lower() in ('true', '1', 't')
+# Локальный кэш часов Tempo по (сотрудник, день): сколько минут данные открытого месяца считаются
+# свежими и через сколько дней после конца месяца он закрыт (закрытые месяцы повторно не запрашиваются)
+TEMPO_CACHE_TTL_MINUTES = float(get_env("TEMPO_CACHE_TTL_MINUTES", "30"))
+TEMPO_CACHE_GRACE_DAYS = int(get_env("TEMPO_CACHE_GRACE_DAYS", "10"))
+# Размер пула keep-alive соединений к Jira (не меньше числа параллельных запросов)
+HTTP_POOL_SIZE = int(get_env("HTTP_POOL_SIZE", str(max(JIRA_USERS_FETCH_WORKERS, JIRA_LOOKUP_WORKERS, TEMPO_FETCH_WORKERS, TEMPO_TEAMS_FETCH_WORKERS) + 2)))
 
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 def get_headers():
@@ -51,47 +116,260 @@ def get_headers():
         return {"Authorization": f"Bearer {JIRA_TOKEN}", "Content-Type": "application/json"}
     return {"Cookie": f"JSESSIONID={JIRA_TOKEN}", "Content-Type": "application/json"}
 
-def get_all_jira_users():
-    print("⏳ Кэширование пользователей Jira...", flush=True)
-    users = []
-    search_queries = ['.', '@', '']
-    for query in search_queries:
+# Общие сессии для всех потоков: соединения с Jira и Mattermost переиспользуются между запросами
+JIRA_SESSION = http_session.create_session("jira", get_headers(), VERIFY_SSL, HTTP_POOL_SIZE)
+MM_SESSION = http_session.create_session("mattermost", {"Authorization": f"Bearer {MM_TOKEN}"}, VERIFY_SSL, 4, timeout=60)
+
+def search_jira_users(query):
+    """
+    Все страницы /user/search для одной маски: (пользователи, получены ли все страницы).
+    При ошибке возвращается то, что успели получить, и False.
+    """
+    found = []
+    start_at = 0
+    while True:
+        url = f"https://{JIRA_DOMAIN}/rest/api/2/user/search"
+        params = {"username": query, "startAt": start_at, "maxResults": 1000, "includeInactive": "false"}
+        try:
+            resp = JIRA_SESSION.get(url, params=params)
+            if resp.status_code != 200:
+                print(f"⚠️ Поиск пользователей '{query}': HTTP {resp.status_code}", flush=True)
+                return found, False
+            chunk = resp.json()
+            if not chunk: break
+            found.extend(chunk)
+            if len(chunk) < 1000: break
+            start_at += len(chunk)
+        except Exception as e:
+            print(f"⚠️ Поиск пользователей '{query}': {e}", flush=True)
+            return found, False
+    return found, True
+
+def fetch_jira_users_by_masks():
+    """Исходный способ: последовательно пробуем широкие маски '.', '@', ''. Возвращает (пользователи, полный ли ответ)."""
+    for query in ['.', '@', '']:
         print(f"🔎 Поиск пользователей API Jira по маске: '{query}'", flush=True)
-        temp_users = []
-        start_at = 0
-        while True:
-            url = f"https://{JIRA_DOMAIN}/rest/api/2/user/search"
-            params = {"username": query, "startAt": start_at, "maxResults": 1000, "includeInactive": "false"}
-            try:
-                resp = requests.get(url, headers=get_headers(), params=params, verify=VERIFY_SSL, timeout=(10, 30))
-                if resp.status_code != 200: break
-                chunk = resp.json()
-                if not chunk: break
-                temp_users.extend(chunk)
-                if len(chunk) < 1000: break
-                start_at += len(chunk)
-            except: break
-        if temp_users:
-            users = temp_users
-            break
-
-    lookup_map = {}
-    key_map = {}
-    for u in users:
-        login = u.get('name')
-        key = u.get('key')
-        d_name = u.get('displayName')
-        if not key: key = login
-        user_obj = {'login': login, 'key': key, 'displayName': d_name}
-        if key: key_map[key] = user_obj
-        if d_name:
-            lookup_map[d_name.lower()] = user_obj
-            parts = d_name.split()
-            if len(parts) == 2:
-                rev_name = f"{parts[1]} {parts[0]}"
-                lookup_map[rev_name.lower()] = user_obj
-        if login: lookup_map[login.lower()] = user_obj
-    return lookup_map, key_map
+        found, complete = search_jira_users(query)
+        if found or not complete: return found, complete
+    return [], True
+
+def fetch_jira_users_sharded():
+    """
+    Загрузка по префиксам (a–z, а–я, 0–9) параллельно в пуле из JIRA_USERS_FETCH_WORKERS потоков.
+    Jira Server молча обрезает выдачу широких масок, поэтому префикс, вернувший
+    JIRA_USERS_SHARD_LIMIT и больше пользователей, делится дальше (до USER_SHARD_MAX_DEPTH символов).
+    Результаты объединяются без дублей по key и упорядочиваются по логину.
+    Возвращает (пользователи, получены ли все префиксы полностью).
+    """
+    shard_counts = {}
+    merged = {}
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=JIRA_USERS_FETCH_WORKERS) as pool:
+        pending = {pool.submit(search_jira_users, p): p for p in USER_SHARD_PREFIXES}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                prefix = pending.pop(future)
+                found, complete = future.result()
+                if not complete: failed.append(prefix)
+                shard_counts[prefix] = len(found)
+                for u in found:
+                    merged.setdefault(u.get('key') or u.get('name'), u)
+                if len(found) >= JIRA_USERS_SHARD_LIMIT and len(prefix) < USER_SHARD_MAX_DEPTH:
+                    alphabet = USER_SHARD_CYRILLIC if prefix[0] in USER_SHARD_CYRILLIC else USER_SHARD_LATIN + "0123456789._-"
+                    for ch in alphabet:
+                        pending[pool.submit(search_jira_users, prefix + ch)] = prefix + ch
+
+    counts = " ".join(f"{p}={shard_counts[p]}" for p in sorted(shard_counts) if shard_counts[p])
+    capped = [p for p in shard_counts if shard_counts[p] >= JIRA_USERS_SHARD_LIMIT and len(p) >= USER_SHARD_MAX_DEPTH]
+    if capped: print(f"⚠️ Выдача могла быть обрезана для префиксов: {', '.join(sorted(capped))}", flush=True)
+    if failed: print(f"⚠️ Не удалось получить пользователей по префиксам: {', '.join(sorted(failed))}", flush=True)
+    print(f"🔎 Пользователи Jira по префиксам ({len(shard_counts)} запросов): {counts}", flush=True)
+    merged.pop(None, None)
+    return sorted(merged.values(), key=lambda u: str(u.get('name') or u.get('key')).lower()), not failed
+
+def fetch_group_members(group_name):
+    """Все активные участники группы Jira (постранично через /group/member): (участники, получены ли все страницы)."""
+    found = []
+    start_at = 0
+    while True:
+        url = f"https://{JIRA_DOMAIN}/rest/api/2/group/member"
+        params = {"groupname": group_name, "startAt": start_at, "maxResults": 50, "includeInactiveUsers": "false"}
+        try:
+            resp = JIRA_SESSION.get(url, params=params)
+            if resp.status_code != 200:
+                print(f"⚠️ Группа '{group_name}': HTTP {resp.status_code}", flush=True)
+                return found, False
+            page = resp.json()
+            values = page.get('values', [])
+            found.extend(values)
+            if page.get('isLast', True) or not values: break
+            start_at += len(values)
+        except Exception as e:
+            print(f"⚠️ Группа '{group_name}': {e}", flush=True)
+            return found, False
+    return found, True
+
+def fetch_jira_users_by_groups():
+    """
+    Справочник только из участников групп JIRA_USER_GROUPS (группы загружаются параллельно).
+    Участники нескольких групп попадают в справочник один раз, порядок — по логину.
+    Возвращает (пользователи, получены ли все группы полностью).
+    """
+    if not JIRA_USER_GROUPS:
+        print("⚠️ Режим groups: не задан JIRA_USER_GROUPS", flush=True)
+        return [], False
+    merged = {}
+    complete = True
+    with ThreadPoolExecutor(max_workers=min(JIRA_USERS_FETCH_WORKERS, len(JIRA_USER_GROUPS))) as pool:
+        for group_name, (members, group_complete) in zip(JIRA_USER_GROUPS, pool.map(fetch_group_members, JIRA_USER_GROUPS)):
+            print(f"👥 Группа '{group_name}': {len(members)} участников", flush=True)
+            complete = complete and group_complete
+            for u in members:
+                merged.setdefault(u.get('key') or u.get('name'), u)
+    merged.pop(None, None)
+    return sorted(merged.values(), key=lambda u: str(u.get('name') or u.get('key')).lower()), complete
+
+def get_all_jira_users():
+    """Справочник из Jira: (UserDirectory, все ли запросы загрузки выполнены полностью)."""
+    print(f"⏳ Кэширование пользователей Jira (режим: {JIRA_USERS_LOAD_MODE})...", flush=True)
+    if JIRA_USERS_LOAD_MODE == "sharded":
+        users, complete = fetch_jira_users_sharded()
+    elif JIRA_USERS_LOAD_MODE == "groups":
+        users, complete = fetch_jira_users_by_groups()
+    else:
+        users, complete = fetch_jira_users_by_masks()
+
+    directory = jira_users.UserDirectory(users)
+    print(f"✅ Пользователей Jira: {len(directory)}, фамилий в индексе: {len(directory.surname_index)}", flush=True)
+    return directory, complete
+
+def refresh_jira_directory():
+    """
+    Загружает справочник из Jira, подменяет JIRA_DIRECTORY и обновляет снимок на диске.
+    Новый справочник строится целиком в вызывающем потоке и публикуется одним
+    присваиванием ссылки: задачи, которые уже взяли старый справочник, дорабатывают
+    на нем. Пустой или неполный результат (ошибка части запросов) и резкое уменьшение
+    справочника (больше JIRA_USERS_MAX_DROP_PERCENT) не затирают текущий справочник и снимок;
+    неполный справочник публикуется, только если текущий пуст (первый запуск без снимка).
+    """
+    global JIRA_DIRECTORY
+    if not _REFRESH_LOCK.acquire(blocking=False):
+        print("ℹ️ Обновление справочника уже выполняется.", flush=True)
+        return JIRA_DIRECTORY
+    try:
+        directory, complete = get_all_jira_users()
+        if not len(directory):
+            print("⚠️ Jira вернула пустой справочник, оставляю текущий.", flush=True)
+            return JIRA_DIRECTORY
+        if not complete:
+            if not len(JIRA_DIRECTORY):
+                print("⚠️ Справочник загружен не полностью: использую его до следующего обновления, снимок не сохраняю.", flush=True)
+                JIRA_DIRECTORY = directory
+            else:
+                print("⚠️ Справочник загружен не полностью, оставляю текущий.", flush=True)
+            return JIRA_DIRECTORY
+        if len(directory) < len(JIRA_DIRECTORY) * (1 - JIRA_USERS_MAX_DROP_PERCENT / 100):
+            print(f"⚠️ Справочник уменьшился с {len(JIRA_DIRECTORY)} до {len(directory)} пользователей, оставляю текущий.", flush=True)
+            return JIRA_DIRECTORY
+        JIRA_DIRECTORY = directory
+        jira_users.save_snapshot(directory, JIRA_SNAPSHOT_PATH)
+        print(f"💾 Снимок справочника сохранен: {JIRA_SNAPSHOT_PATH}", flush=True)
+    except Exception as e:
+        print(f"⚠️ Ошибка обновления справочника Jira: {e}", flush=True)
+    finally:
+        _REFRESH_LOCK.release()
+    return JIRA_DIRECTORY
+
+def directory_refresh_loop(refresh_now=False):
+    """Фоновый поток: обновляет справочник сразу (если нужно) и затем каждые JIRA_USERS_REFRESH_MINUTES."""
+    if refresh_now: refresh_jira_directory()
+    while JIRA_USERS_REFRESH_MINUTES > 0:
+        time.sleep(JIRA_USERS_REFRESH_MINUTES * 60)
+        refresh_jira_directory()
+
+# --- ТОЧЕЧНЫЙ ПОИСК ПОЛЬЗОВАТЕЛЕЙ ---
+class LookupCache:
+    """
+    Потокобезопасный LRU-кэш ответов Jira с временем жизни записей.
+    Пустые ответы тоже кэшируются (negative caching), но живут меньше.
+    """
+    def __init__(self, max_size, ttl_seconds, negative_ttl_seconds):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Возвращает (найдено ли в кэше, значение)."""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None: return False, None
+            expires_at, value = item
+            if expires_at < time.time():
+                del self._items[key]
+                return False, None
+            self._items.move_to_end(key)
+            return True, value
+
+    def put(self, key, value):
+        ttl = self.ttl_seconds if value else self.negative_ttl_seconds
+        with self._lock:
+            self._items[key] = (time.time() + ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+JIRA_LOOKUP_CACHE = LookupCache(JIRA_LOOKUP_CACHE_SIZE, JIRA_LOOKUP_TTL_MINUTES * 60, JIRA_LOOKUP_NEGATIVE_TTL_MINUTES * 60)
+
+def lookup_jira_users(query):
+    """Один запрос /user/search. Возвращает список пользователей или None при ошибке (такое не кэшируется)."""
+    url = f"https://{JIRA_DOMAIN}/rest/api/2/user/search"
+    params = {"username": query, "maxResults": 100, "includeInactive": "false"}
+    try:
+        resp = JIRA_SESSION.get(url, params=params)
+        if resp.status_code != 200: return None
+        return resp.json()
+    except: return None
+
+def lookup_missing_users(names, stats=None):
+    """
+    Ищет напрямую в Jira сотрудников, которых не удалось найти в справочнике.
+    Запрашиваются только главные фамилии из 1С (каждая один раз, параллельно),
+    ответы хранятся в JIRA_LOOKUP_CACHE. Найденные записи проверяются теми же
+    уровнями, что и справочник. Возвращает {нормализованное ФИО: (JiraUser, уверенность)}.
+    """
+    by_surname = {}
+    for name in names:
+        e_long = jira_users.parse_name(name)[1]
+        if e_long: by_surname.setdefault(e_long[0], []).append(name)
+
+    results = {}
+    to_fetch = []
+    for surname in by_surname:
+        hit, value = JIRA_LOOKUP_CACHE.get(surname)
+        if hit: results[surname] = value
+        else: to_fetch.append(surname)
+
+    if to_fetch:
+        with ThreadPoolExecutor(max_workers=JIRA_LOOKUP_WORKERS) as pool:
+            for surname, found in zip(to_fetch, pool.map(lookup_jira_users, to_fetch)):
+                if found is None: continue
+                JIRA_LOOKUP_CACHE.put(surname, found)
+                results[surname] = found
+    if stats is not None: stats['lookup_requests'] += len(to_fetch)
+
+    matched = {}
+    for surname, raw_users in results.items():
+        if not raw_users: continue
+        candidates = jira_users.UserDirectory(raw_users)
+        for name in by_surname[surname]:
+            user, _, score = candidates.resolve(name)
+            if user: matched[jira_users.normalize_name(name)] = (user, score)
+    if stats is not None: stats['lookup'] += len(matched)
+    return matched
 
 def update_progress_message(post_id, channel_id, message):
     try:
@@ -119,87 +397,617 @@ def get_team_rank(team_name):
         return (3, num, tn)
     return (4, 0, tn)
 
-def get_tempo_teams_assignments(report_start_date, report_end_date):
+def get_tempo_teams(report_start_date, report_end_date):
+    """
+    Команды Tempo из отчета (stream*-team, change-team, arch-team) с участниками, чье членство
+    пересекается с периодом: {id команды: {'name': имя, 'members': {jira_key: (с, по)}}}.
+    Ответ берется из снимка составов за этот же период, если снимок моложе TEMPO_TEAMS_TTL_MINUTES
+    или сделан уже после закрытия периода (см. month_closed_at) — тогда он действует бессрочно.
+    Иначе составы загружаются из Tempo, и полный ответ сохраняется как новый снимок периода.
+    """
+    taken_at, snapshot = storage.load_team_snapshot(report_start_date.isoformat(), report_end_date.isoformat())
+    if taken_at is not None:
+        if taken_at >= month_closed_at(report_end_date) or time.time() - taken_at < TEMPO_TEAMS_TTL_MINUTES * 60:
+            print(f"ℹ️ Составы команд Tempo взяты из снимка (команд: {len(snapshot)})", flush=True)
+            return snapshot
+
+    teams_info, complete = fetch_tempo_teams(report_start_date, report_end_date)
+    if complete: storage.save_team_snapshot(report_start_date.isoformat(), report_end_date.isoformat(), teams_info)
+    elif taken_at is not None:
+        print("⚠️ Tempo ответил не полностью, использую прежний снимок составов команд", flush=True)
+        return snapshot
+    return teams_info
+
+def fetch_tempo_teams(report_start_date, report_end_date):
+    """Команды и составы из Tempo (см. get_tempo_teams). Возвращает (teams_info, все ли составы получены)."""
     print("⏳ Анализ команд Tempo...", flush=True)
     try:
-        resp = requests.get(f"https://{JIRA_DOMAIN}/rest/tempo-teams/2/team", headers=get_headers(), verify=VERIFY_SSL, timeout=30)
-        if resp.status_code != 200: return {}
+        resp = JIRA_SESSION.get(f"https://{JIRA_DOMAIN}/rest/tempo-teams/2/team", timeout=30)
+        if resp.status_code != 200: return {}, False
         all_teams = resp.json()
-    except: return {}
+    except: return {}, False
 
     target_teams = []
     pattern = re.compile(r"^(stream.*-team|change-team|arch-team)$", re.IGNORECASE)
     for team in all_teams:
         if pattern.match(team.get("name", "")): target_teams.append(team)
 
-    user_team_map = {}
+    # Составы команд загружаются параллельно, каждый ответ разбирается сразу в потоке запроса
+    members_by_team = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(TEMPO_TEAMS_FETCH_WORKERS, len(target_teams) or 1))) as pool:
+        futures = {pool.submit(fetch_team_members, team.get("id"), report_start_date, report_end_date): team.get("id") for team in target_teams}
+        for future in as_completed(futures):
+            members_by_team[futures[future]] = future.result()
+
+    failed = [team.get("name") for team in target_teams if members_by_team.get(team.get("id")) is None]
+    if failed: print(f"⚠️ Не удалось получить составы команд: {', '.join(failed)}", flush=True)
+    teams_info = {}
     for team in target_teams:
+        teams_info[team.get("id")] = {"name": team.get("name"), "members": members_by_team.get(team.get("id")) or {}}
+    return teams_info, not failed
+
+def fetch_team_members(team_id, report_start_date, report_end_date):
+    """
+    Участники команды Tempo, чье членство пересекается с периодом: {jira_key: (с, по)}.
+    Ошибка сервера, 429 или обрыв повторяются до TEMPO_RETRIES раз с растущей задержкой.
+    None — состав получить не удалось (в том числе отказ 4xx); {} — в команде за период никого нет.
+    """
+    for attempt in range(TEMPO_RETRIES + 1):
+        if attempt:
+            delay = TEMPO_BACKOFF_SECONDS * 2 ** (attempt - 1)
+            time.sleep(delay / 2 + random.uniform(0, delay / 2))
         try:
-            m_resp = requests.get(f"https://{JIRA_DOMAIN}/rest/tempo-teams/2/team/{team.get('id')}/member", headers=get_headers(), verify=VERIFY_SSL, timeout=30)
-            if m_resp.status_code == 200:
-                for m in m_resp.json():
-                    jira_key = m.get("member", {}).get("key")
-                    if not jira_key: continue
-                    ms = m.get("membership", {})
-                    d_from = parse_tempo_date(ms.get('dateFromANSI') or ms.get('dateFrom')) or date(2000, 1, 1)
-                    d_to = parse_tempo_date(ms.get('dateToANSI') or ms.get('dateTo')) or date(2099, 12, 31)
-                    if d_from <= report_end_date and d_to >= report_start_date:
-                        user_team_map[jira_key] = team.get("name")
-        except: pass
+            m_resp = JIRA_SESSION.get(f"https://{JIRA_DOMAIN}/rest/tempo-teams/2/team/{team_id}/member", timeout=30)
+            if m_resp.status_code == 429 or m_resp.status_code >= 500: continue
+            if m_resp.status_code != 200:
+                print(f"⚠️ Tempo отклонил запрос состава команды {team_id} ({m_resp.status_code})", flush=True)
+                return None
+            members = {}
+            for m in m_resp.json():
+                jira_key = m.get("member", {}).get("key")
+                if not jira_key: continue
+                ms = m.get("membership", {})
+                d_from = parse_tempo_date(ms.get('dateFromANSI') or ms.get('dateFrom')) or date(2000, 1, 1)
+                d_to = parse_tempo_date(ms.get('dateToANSI') or ms.get('dateTo')) or date(2099, 12, 31)
+                if d_from <= report_end_date and d_to >= report_start_date:
+                    members[jira_key] = (d_from, d_to)
+            return members
+        except (requests.exceptions.RequestException, ValueError):
+            continue
+    return None
+
+def team_assignments(teams_info):
+    """{jira_key: имя команды}; если сотрудник в нескольких командах, побеждает последняя."""
+    user_team_map = {}
+    for team in teams_info.values():
+        for jira_key in team["members"]:
+            user_team_map[jira_key] = team["name"]
     return user_team_map
 
-def fetch_tempo_worklogs_for_users(start_date, end_date, worker_ids, progress_callback=None):
-    all_worklogs = []
-    chunks = [worker_ids[i:i + 25] for i in range(0, len(worker_ids), 25)]
-    for i, chunk_workers in enumerate(chunks):
-        if progress_callback: progress_callback(i + 1, len(chunks))
-        payload = {"from": start_date.strftime("%Y-%m-%d"), "to": end_date.strftime("%Y-%m-%d"), "worker": chunk_workers}
-        try:
-            resp = requests.post(f"https://{JIRA_DOMAIN}/rest/tempo-timesheets/4/worklogs/search", headers=get_headers(), json=payload, verify=VERIFY_SSL, timeout=90)
-            if resp.status_code == 200: all_worklogs.extend(resp.json().get('results', []) if isinstance(resp.json(), dict) else resp.json())
-        except: pass
-    return all_worklogs
-
-# --- ИСПРАВЛЕННАЯ ФУНКЦИЯ СОПОСТАВЛЕНИЯ ИМЕН (v3 - поддержка "уулу") ---
-def check_name_match(jira_name, excel_name):
-    if not jira_name or not excel_name: return False
-    
-    # Меняем точки и дефисы на пробелы, чтобы корректно читать составные имена
-    j_clean = str(jira_name).lower().replace('.', ' ').replace('-', ' ').strip()
-    e_clean = str(excel_name).lower().replace('.', ' ').replace('-', ' ').strip()
-    
-    j_parts = [p for p in j_clean.split() if p]
-    e_parts = [p for p in e_clean.split() if p]
-    
-    if not j_parts or not e_parts: return False
-
-    # Разделяем на слова длиннее 1 символа (фамилии, приставки)
-    j_long = [p for p in j_parts if len(p) > 1]
-    e_long = [p for p in e_parts if len(p) > 1]
-
-    if not e_long: return False # В 1С нет фамилии, пропускаем
-
-    # 1. Главная фамилия из 1С (первое слово) ДОЛЖНА быть в учетке Jira
-    primary_surname = e_long[0]
-    if primary_surname not in j_long:
-        return False
-
-    # 2. Находим все общие длинные слова (фамилия + возможные уулу/кызы/оглы)
-    common_long = set(j_long).intersection(set(e_long))
-    
-    # 3. Достаем инициалы из 1С (одиночные буквы)
-    e_initials = [p for p in e_parts if len(p) == 1]
-    if not e_initials:
-        return True # Если нет инициала, а основная фамилия совпала — прощаем
-        
-    # 4. Проверяем оставшиеся слова в учетке Jira (это должно быть имя/отчество)
-    j_leftovers = [p for p in j_parts if p not in common_long]
-    if not j_leftovers:
-        return True # В Jira указана только фамилия без имени, считаем совпадением
-        
-    # Проверяем, начинается ли хотя бы одно из оставшихся слов в Jira на первый инициал из 1С
-    first_initial = e_initials[0]
-    return any(p.startswith(first_initial) for p in j_leftovers)
+class ChunkSizer:
+    """
+    Подбирает размер пачки сотрудников для запроса ворклогов.
+    Полная пачка, ответившая быстрее целевого времени, увеличивает размер в полтора раза;
+    медленный или слишком большой ответ уменьшает его пропорционально превышению,
+    таймаут или ошибка сервера — вдвое.
+    """
+    def __init__(self, size, max_size, target_seconds, max_bytes):
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self.size = self.clamp(size)
+
+    def clamp(self, size):
+        return max(1, min(self.max_size, int(size)))
+
+    def on_success(self, n, elapsed, size_bytes):
+        if size_bytes > self.max_bytes:
+            self.size = self.clamp(min(self.size, n * self.max_bytes / size_bytes))
+        elif elapsed > self.target_seconds:
+            self.size = self.clamp(min(self.size, n * self.target_seconds / elapsed))
+        elif n >= self.size:
+            self.size = self.clamp(self.size * 1.5 + 1)
+
+    def on_failure(self, n):
+        self.size = self.clamp(min(self.size, n // 2))
+
+def fold_worklogs(worklogs, totals, day_totals=None):
+    """Добавляет часы ворклогов в счетчики: totals[worker] и day_totals[(worker, 'YYYY-MM-DD')] (секунды)."""
+    for w in worklogs:
+        worker = w.get('worker')
+        seconds = w.get('timeSpentSeconds', 0) or 0
+        totals[worker] += seconds
+        if day_totals is not None: day_totals[(worker, str(w.get('dateStarted', ''))[:10])] += seconds
+
+def alias_workers(totals, day_totals, aliases):
+    """Счетчики ячейки, в которых worker заменен по aliases ({логин: ключ Jira}); прочие worker не меняются."""
+    aliased = Counter()
+    for worker, seconds in totals.items(): aliased[aliases.get(worker, worker)] += seconds
+    if day_totals is None: return aliased, None
+    aliased_days = Counter()
+    for (worker, day), seconds in day_totals.items(): aliased_days[(aliases.get(worker, worker), day)] += seconds
+    return aliased, aliased_days
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешнего сервиса, общий для всех задач: после threshold ошибок подряд
+    запросы не выполняются cooldown_seconds секунд, затем пропускается одна пробная попытка.
+    Успешный запрос сбрасывает счетчик ошибок. trips — сколько раз предохранитель размыкался.
+    """
+    def __init__(self, name, threshold, cooldown_seconds):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.trips = 0
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None: return True
+            if time.monotonic() - self._opened_at < self.cooldown_seconds: return False
+            # Пробная попытка: следующие ждут ее результата до конца нового интервала
+            self._opened_at = time.monotonic()
+            return True
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._failures >= self.threshold:
+                self.trips += 1
+                if self._opened_at is None: print(f"🔌 {self.name} недоступен ({self._failures} ошибок подряд), пауза {int(self.cooldown_seconds)} с", flush=True)
+                self._opened_at = time.monotonic()
+
+TEMPO_BREAKER = CircuitBreaker("Tempo", TEMPO_BREAKER_THRESHOLD, TEMPO_BREAKER_COOLDOWN)
+
+def fetch_tempo_worklog_chunk(start_date, end_date, query, by_day=False):
+    """
+    Один запрос ворклогов с фильтром query ({"worker": [...]}, {"teamId": [...]} или {} — все);
+    ответ сразу сворачивается в счетчики.
+    Возвращает ((totals, day_totals) или None, секунд на запрос, размер ответа в байтах, ошибка).
+    Ошибка: None — успех, 'timeout' — таймаут чтения или слишком большой ответ (пачку нужно
+    уменьшить), 'error' — обрыв, ошибка сервера, 429 или некорректный ответ (стоит повторить),
+    'rejected' — остальные ответы 4xx (нет доступа, неверный запрос): повтор не поможет.
+    """
+    payload = dict(query, **{"from": start_date.strftime("%Y-%m-%d"), "to": end_date.strftime("%Y-%m-%d")})
+    started = time.monotonic()
+    try:
+        resp = JIRA_SESSION.post(f"https://{JIRA_DOMAIN}/rest/tempo-timesheets/4/worklogs/search", json=payload, timeout=TEMPO_CHUNK_TIMEOUT, stream=TEMPO_STREAM_PARSE)
+        with resp:
+            if resp.status_code in (413, 504): return None, time.monotonic() - started, 0, 'timeout'
+            if resp.status_code == 429 or resp.status_code >= 500: return None, time.monotonic() - started, 0, 'error'
+            if resp.status_code != 200:
+                print(f"⚠️ Tempo отклонил запрос ворклогов ({resp.status_code}): {resp.text[:200]}", flush=True)
+                return None, time.monotonic() - started, 0, 'rejected'
+            totals, day_totals = Counter(), (Counter() if by_day else None)
+            if TEMPO_STREAM_PARSE:
+                reader = tempo_stream.CountingReader(resp.raw)
+                fold_worklogs(tempo_stream.iter_worklogs(reader), totals, day_totals)
+                size_bytes = reader.bytes_read
+            else:
+                data = resp.json()
+                fold_worklogs(data.get('results', []) if isinstance(data, dict) else data, totals, day_totals)
+                size_bytes = len(resp.content)
+            return (totals, day_totals), time.monotonic() - started, size_bytes, None
+    except (requests.exceptions.ReadTimeout, requests.packages.urllib3.exceptions.ReadTimeoutError):
+        return None, time.monotonic() - started, 0, 'timeout'
+    except (requests.exceptions.RequestException, requests.packages.urllib3.exceptions.HTTPError, ValueError):
+        return None, time.monotonic() - started, 0, 'error'
+
+def fetch_tempo_cell(start_date, end_date, query, by_day=False):
+    """
+    fetch_tempo_worklog_chunk с повторами: ошибка 'error' повторяется до TEMPO_RETRIES раз
+    с экспоненциальной задержкой и случайным разбросом (чтобы параллельные запросы не повторялись
+    одновременно). Таймаут (пачку нужно уменьшить) и отказ 'rejected' не повторяются. Пока
+    предохранитель Tempo разомкнут, запрос не выполняется и возвращается ошибка 'breaker'.
+    """
+    for attempt in range(TEMPO_RETRIES + 1):
+        if not TEMPO_BREAKER.allow(): return None, 0, 0, 'breaker'
+        result, elapsed, size_bytes, error = fetch_tempo_worklog_chunk(start_date, end_date, query, by_day)
+        # Таймаут (пачку можно уменьшить) и отказ 4xx состояние предохранителя не меняют
+        if error in (None, 'error'): TEMPO_BREAKER.record(error is None)
+        if error != 'error' or attempt == TEMPO_RETRIES: return result, elapsed, size_bytes, error
+        delay = TEMPO_BACKOFF_SECONDS * 2 ** attempt
+        time.sleep(delay / 2 + random.uniform(0, delay / 2))
+
+def split_period(start_date, end_date, window_days):
+    """Окна [(начало, конец)] по window_days дней, покрывающие период; window_days <= 0 — одно окно."""
+    if window_days <= 0: return [(start_date, end_date)]
+    windows = []
+    while start_date <= end_date:
+        window_end = min(end_date, start_date + timedelta(days=window_days - 1))
+        windows.append((start_date, window_end))
+        start_date = window_end + timedelta(days=1)
+    return windows
+
+def fetch_tempo_worker_totals(start_date, end_date, worker_ids, progress_callback=None, by_day=False, on_cell=None, plan=None, aliases=None):
+    """
+    Часы сотрудников по ворклогам Tempo: (totals, day_totals, failed, team_totals) — секунды по worker,
+    по (worker, 'YYYY-MM-DD') при by_day (иначе None), список неполученных и секунды по (worker, id команды).
+    """
+    totals, day_totals = Counter(), (Counter() if by_day else None)
+    team_totals = Counter()
+    if not worker_ids: return totals, day_totals, [], team_totals
+    if plan is None: plan = {"strategy": "workers", "cells": [], "rest": list(worker_ids)}
+    sizer = ChunkSizer(storage.load_setting("tempo_chunk_size", TEMPO_CHUNK_SIZE), TEMPO_CHUNK_MAX, TEMPO_CHUNK_TARGET_SECONDS, TEMPO_CHUNK_MAX_BYTES)
+    windows = split_period(start_date, end_date, TEMPO_WINDOW_DAYS)
+    # Ячейки с фиксированным фильтром (команды, весь период) и очередь окон для пачек сотрудников
+    retry = deque((ws, we, query, workers) for ws, we in windows for query, workers in plan["cells"])
+    rest = plan["rest"]
+    chunk_windows = deque(windows if rest else [])
+    failed = set()
+    seen_workers = set()
+    requested = set(worker_ids)
+    next_pos = 0
+    done_cells = 0
+    total_cells = len(worker_ids) * ((end_date - start_date).days + 1)
+    requests_count = 0
+    bytes_total = 0
+    trips_before = TEMPO_BREAKER.trips
+    started = time.monotonic()
+
+    def next_cell():
+        nonlocal next_pos
+        if retry: return retry.popleft()
+        window_start, window_end = chunk_windows[0]
+        chunk = rest[next_pos:next_pos + sizer.size]
+        next_pos += len(chunk)
+        if next_pos >= len(rest):
+            chunk_windows.popleft()
+            next_pos = 0
+        return window_start, window_end, {"worker": chunk}, chunk
+
+    with ThreadPoolExecutor(max_workers=max(1, TEMPO_FETCH_WORKERS)) as pool:
+        pending = {}
+        while True:
+            while len(pending) < max(1, TEMPO_FETCH_WORKERS) and (retry or chunk_windows):
+                cell = next_cell()
+                pending[pool.submit(fetch_tempo_cell, cell[0], cell[1], cell[2], by_day)] = cell
+                requests_count += 1
+            if not pending: break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                window_start, window_end, query, workers = pending.pop(future)
+                cell_totals, elapsed, size_bytes, error = future.result()
+                bytes_total += size_bytes
+                by_workers = "worker" in query
+                if error in ('breaker', 'rejected'):
+                    failed.update(workers)
+                elif cell_totals is None:
+                    if by_workers: sizer.on_failure(len(workers))
+                    if by_workers and len(workers) > 1:
+                        half = len(workers) // 2
+                        retry.appendleft((window_start, window_end, {"worker": workers[half:]}, workers[half:]))
+                        retry.appendleft((window_start, window_end, {"worker": workers[:half]}, workers[:half]))
+                        continue
+                    if window_end > window_start:
+                        middle = window_start + (window_end - window_start) // 2
+                        retry.appendleft((middle + timedelta(days=1), window_end, query, workers))
+                        retry.appendleft((window_start, middle, query, workers))
+                        continue
+                    # Таймаут даже на одном сотруднике за один день — Tempo не отвечает, а не перегружен пачкой
+                    if error == 'timeout': TEMPO_BREAKER.record(False)
+                    failed.update(workers)
+                else:
+                    cell_sums, cell_days = cell_totals
+                    # В ответе по одному сотруднику все ворклоги его, как бы Tempo его ни назвал
+                    cell_aliases = dict.fromkeys(cell_sums, workers[0]) if by_workers and len(workers) == 1 else aliases
+                    if cell_aliases: cell_sums, cell_days = alias_workers(cell_sums, cell_days, cell_aliases)
+                    if by_workers:
+                        sizer.on_success(len(workers), elapsed, size_bytes)
+                    else:
+                        seen_workers.update(cell_sums)
+                        for team_id in query.get("teamId", []):
+                            team_totals.update({(w, team_id): v for w, v in cell_sums.items() if w in requested})
+                    keep = set(workers)
+                    cell_sums = Counter({w: v for w, v in cell_sums.items() if w in keep})
+                    if by_day: cell_days = Counter({k: v for k, v in cell_days.items() if k[0] in keep})
+                    totals.update(cell_sums)
+                    if by_day: day_totals.update(cell_days)
+                    if on_cell: on_cell(window_start, window_end, workers, cell_days)
+                done_cells += len(workers) * ((window_end - window_start).days + 1)
+                if progress_callback: progress_callback(done_cells, total_cells)
+
+    failed = sorted(failed)
+    if failed: print(f"⚠️ Tempo не вернул ворклоги сотрудников (полностью или частично): {', '.join(failed)}", flush=True)
+    print(f"[TEMPO] план {plan['strategy']}: запросов {requests_count}, получено {bytes_total / 1048576:.1f} МБ за {time.monotonic() - started:.1f} с", flush=True)
+    if rest and TEMPO_BREAKER.trips != trips_before:
+        print(f"[TEMPO] Tempo был недоступен, размер пачки {sizer.size} не сохраняю", flush=True)
+    elif rest:
+        print(f"[TEMPO] размер пачки для следующего запуска {sizer.size}", flush=True)
+        storage.save_setting("tempo_chunk_size", sizer.size)
+    if plan["strategy"] == "scan" and seen_workers: storage.save_setting("tempo_population", len(seen_workers))
+    return totals, day_totals, failed, team_totals
+
+def plan_tempo_fetch(start_date, end_date, worker_ids, teams_info=None):
+    """
+    Самый дешевый по оценке способ загрузки (или заданный TEMPO_FETCH_PLAN): {'strategy': workers/teams/scan,
+    'cells': [(фильтр, сотрудники)], 'rest': сотрудники для пачек, 'estimates': (запросов, сотруднико-дней)}.
+    """
+    days = (end_date - start_date).days + 1
+    n_windows = len(split_period(start_date, end_date, TEMPO_WINDOW_DAYS))
+    chunk = max(1, int(storage.load_setting("tempo_chunk_size", TEMPO_CHUNK_SIZE)))
+    population = max(len(worker_ids), int(storage.load_setting("tempo_population", len(JIRA_DIRECTORY) or len(worker_ids))))
+
+    def chunks_cost(n):
+        if not n: return 0, 0
+        return n_windows * -(-n // chunk), n * days
+
+    plans = {"workers": {"strategy": "workers", "cells": [], "rest": list(worker_ids), "estimates": chunks_cost(len(worker_ids))}}
+    plans["scan"] = {"strategy": "scan", "cells": [({}, list(worker_ids))], "rest": [], "estimates": (n_windows, population * days)}
+
+    if teams_info:
+        remaining = set(worker_ids)
+        cells = []
+        team_requests, team_worker_days = 0, 0
+        # Сначала команды, покрывающие больше запрошенных сотрудников на одного участника
+        def coverage(item):
+            members = item[1]["members"]
+            covered = [k for k, (d_from, d_to) in members.items() if k in remaining and d_from <= start_date and d_to >= end_date]
+            return len(covered) / max(1, len(members))
+        for team_id, team in sorted(teams_info.items(), key=coverage, reverse=True):
+            covered = [k for k, (d_from, d_to) in team["members"].items() if k in remaining and d_from <= start_date and d_to >= end_date]
+            if not covered: continue
+            team_cost = n_windows * TEMPO_PLAN_REQUEST_COST + len(team["members"]) * days
+            requests_n, worker_days = chunks_cost(len(covered))
+            if TEMPO_FETCH_PLAN != "teams" and team_cost >= requests_n * TEMPO_PLAN_REQUEST_COST + worker_days: continue
+            cells.append(({"teamId": [team_id]}, covered))
+            remaining.difference_update(covered)
+            team_requests += n_windows
+            team_worker_days += len(team["members"]) * days
+        rest = [k for k in worker_ids if k in remaining]
+        requests_n, worker_days = chunks_cost(len(rest))
+        plans["teams"] = {"strategy": "teams", "cells": cells, "rest": rest, "estimates": (team_requests + requests_n, team_worker_days + worker_days)}
+
+    def cost(plan):
+        requests_n, worker_days = plan["estimates"]
+        return requests_n * TEMPO_PLAN_REQUEST_COST + worker_days
+
+    if TEMPO_FETCH_PLAN in plans: chosen = plans[TEMPO_FETCH_PLAN]
+    else: chosen = min(plans.values(), key=cost)
+    summary = ", ".join(f"{name}: ~{p['estimates'][0]} запросов, ~{p['estimates'][1]} сотруднико-дней" for name, p in plans.items())
+    print(f"[PLAN] {len(worker_ids)} сотрудников, {days} дней -> {chosen['strategy']} ({summary})", flush=True)
+    return chosen
+
+def month_closed_at(day):
+    """Момент, после которого часы за месяц дня day считаются окончательными (конец месяца + TEMPO_CACHE_GRACE_DAYS)."""
+    next_month = (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return datetime.combine(next_month + timedelta(days=TEMPO_CACHE_GRACE_DAYS), datetime.min.time()).timestamp()
+
+def get_tempo_worker_totals(start_date, end_date, worker_ids, progress_callback=None, teams_info=None, aliases=None):
+    """
+    Часы сотрудников за период с кэшем по дням: (totals, incomplete, worker_teams) — секунды по worker,
+    сотрудники с неполученными днями и {worker: имя команды Tempo, к которой отнесено больше всего времени}.
+    """
+    now = time.time()
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    closed_at = {d.isoformat(): month_closed_at(d) for d in days}
+    cached = storage.load_worklog_days(worker_ids, start_date.isoformat(), end_date.isoformat())
+
+    def is_fresh(day, fetched_at):
+        if now >= closed_at[day] and fetched_at >= closed_at[day]: return True
+        return now - fetched_at < TEMPO_CACHE_TTL_MINUTES * 60
+
+    fresh = {(worker, day) for worker, day, _, fetched_at in cached if is_fresh(day, fetched_at)}
+    # Секунды по (сотрудник, день): полученные сейчас, затем свежие из кэша
+    known = {}
+    ranges = {}
+    for worker in worker_ids:
+        stale = [d for d in days if (worker, d.isoformat()) not in fresh]
+        if stale: ranges.setdefault((stale[0], stale[-1]), []).append(worker)
+
+    def checkpoint(window_start, window_end, workers, day_totals):
+        # Вызывается только для ячеек, которые Tempo вернул целиком (ответ 200), с ворклогами,
+        # уже приведенными к запрошенным ключам. Каждая ячейка сразу сохраняется: при сбое повторный
+        # запуск догрузит только остальное. Дни без ворклогов тоже запоминаем (нулями), иначе они
+        # считались бы отсутствующими в кэше
+        rows = Counter({(worker, (window_start + timedelta(days=i)).isoformat()): 0 for worker in workers for i in range((window_end - window_start).days + 1)})
+        rows.update(day_totals)
+        known.update(rows)
+        storage.save_worklog_days([(worker, day, seconds) for (worker, day), seconds in rows.items()])
+
+    to_fetch = sum(len(workers) for workers in ranges.values())
+    team_totals = Counter()
+    print(f"[TEMPO] кэш: {len(worker_ids) - to_fetch} из {len(worker_ids)} сотрудников без запросов, диапазонов к загрузке: {len(ranges)}", flush=True)
+    done_before = 0
+    for (range_start, range_end), workers in ranges.items():
+        def range_progress(done, total, offset=done_before):
+            if progress_callback: progress_callback(offset + done * len(workers) / total, to_fetch)
+        plan = plan_tempo_fetch(range_start, range_end, workers, teams_info)
+        _, _, _, range_team_totals = fetch_tempo_worker_totals(range_start, range_end, workers, range_progress, by_day=True, on_cell=checkpoint, plan=plan, aliases=aliases)
+        team_totals.update(range_team_totals)
+        done_before += len(workers)
+
+    for worker, day, seconds, _ in cached:
+        if (worker, day) in fresh: known.setdefault((worker, day), seconds)
+    totals = Counter()
+    days_known = Counter()
+    for (worker, day), seconds in known.items():
+        totals[worker] += seconds
+        days_known[worker] += 1
+    incomplete = {worker for worker in worker_ids if days_known[worker] < len(days)}
+    # Устаревшие дни, которые не удалось обновить, лучше учесть по кэшу, чем нулем (сотрудник все равно неполный)
+    for worker, day, seconds, _ in cached:
+        if worker in incomplete and (worker, day) not in known: totals[worker] += seconds
+    worker_teams = {}
+    for (worker, team_id), seconds in sorted(team_totals.items(), key=lambda item: item[1]):
+        if seconds > 0 and team_id in (teams_info or {}): worker_teams[worker] = teams_info[team_id]["name"]
+    return totals, incomplete, worker_teams
+
+# --- ПАКЕТНОЕ СОПОСТАВЛЕНИЕ ИМЕН ---
+_TOKENS_FRAME = {}
+_TOKENS_FRAME_LOCK = threading.Lock()
+
+def get_directory_tokens_frame(directory, cache=True):
+    """
+    Слова displayName всех пользователей справочника одной таблицей (pos, key, token, is_long).
+    pos — порядок пользователя в справочнике. Строится один раз на версию справочника;
+    cache=False — для маленьких справочников на одну задачу (составы команд), их не кэшируем.
+    """
+    if not cache: return build_tokens_frame(directory)
+    with _TOKENS_FRAME_LOCK:
+        frame = _TOKENS_FRAME.get(directory.fingerprint)
+        if frame is None:
+            frame = build_tokens_frame(directory)
+            # Держим не больше двух версий: задачи могут доработать на старом справочнике после обновления
+            while len(_TOKENS_FRAME) >= 2: _TOKENS_FRAME.pop(next(iter(_TOKENS_FRAME)))
+            _TOKENS_FRAME[directory.fingerprint] = frame
+    return frame
+
+def build_tokens_frame(directory):
+    rows = [(pos, u.key, t) for pos, u in enumerate(directory.users) for t in u.tokens]
+    frame = pd.DataFrame(rows, columns=['pos', 'key', 'token'])
+    frame['is_long'] = frame['token'].str.len() > 1
+    return frame
+
+def match_by_surname_frame(directory, parsed, cache_frame=True):
+    """
+    Уровень surname для всех имен сразу: join по главной фамилии из 1С со словами
+    справочника и векторная проверка инициала по правилам v3.
+    parsed — DataFrame (name, surname, initial, e_long). Возвращает ({name: jira_key}, число пар).
+    """
+    tokens = get_directory_tokens_frame(directory, cache_frame)
+    long_tokens = tokens.loc[tokens['is_long'], ['pos', 'token']].drop_duplicates()
+    pairs = parsed[['name', 'surname', 'initial']].merge(long_tokens, left_on='surname', right_on='token')
+    pairs = pairs[['name', 'pos', 'initial']]
+    if pairs.empty: return {}, 0
+
+    # Все слова кандидата; "общие" — длинные слова, которые есть и в 1С (фамилия, уулу/кызы/оглы)
+    words = pairs.merge(tokens[['pos', 'token']], on='pos')
+    e_long = parsed[['name', 'e_long']].explode('e_long').rename(columns={'e_long': 'token'}).dropna().drop_duplicates()
+    e_long['common'] = True
+    words = words.merge(e_long, on=['name', 'token'], how='left')
+    words['leftover'] = words['common'].isna()
+    words['initial_hit'] = words['leftover'] & (words['token'].str[0] == words['initial'])
+
+    checks = words.groupby(['name', 'pos'], as_index=False).agg(
+        has_leftover=('leftover', 'any'), initial_hit=('initial_hit', 'any'), initial=('initial', 'first')
+    )
+    checks['match'] = checks['initial'].isna() | ~checks['has_leftover'] | checks['initial_hit']
+    first = checks[checks['match']].sort_values('pos').drop_duplicates('name')
+    return {name: directory.users[pos].key for name, pos in zip(first['name'], first['pos'])}, len(pairs)
+
+def resolve_names(names, directory=None, stats=None, roster=None):
+    """
+    Сопоставляет весь список ФИО из 1С с пользователями Jira за один проход.
+    Возвращает DataFrame по строке на каждое входное имя: name_1c, name (нормализованное),
+    jira_key (None, если не найден), tier — уровень, на котором найдено совпадение,
+    и score — уверенность от 0 до 1 (меньше 1 только у нечеткого уровня trigram).
+    Порядок уровней тот же, что в UserDirectory.resolve; перед ними — постоянный кэш
+    сопоставлений, а уровень surname выполняется join'ом по всем именам сразу.
+    roster — небольшой справочник участников команд Tempo: на уровнях exact и surname имя
+    сначала ищется в нем, затем во всем справочнике; остальные уровни — только по справочнику.
+    """
+    if directory is None: directory = JIRA_DIRECTORY
+    result = pd.DataFrame({'name_1c': list(names)}, dtype=object)
+    result['name'] = result['name_1c'].map(jira_users.normalize_name)
+    q = pd.DataFrame({'name': result['name'].unique()}, dtype=object)
+    q['jira_key'] = None
+    q['tier'] = None
+    q['score'] = 0.0
+
+    # 0. Кэш сопоставлений прошлых запусков (действителен, пока не изменился справочник);
+    # найденный ключ перепроверяется по текущим справочнику и составам команд
+    cached = storage.load_name_resolutions(q['name'].tolist(), directory.fingerprint)
+    for i, name in q['name'].items():
+        if name not in cached: continue
+        key, score = cached[name]
+        if key is None or cached_match_valid(name, key, directory, roster):
+            q.at[i, 'jira_key'], q.at[i, 'tier'] = key, 'cache'
+            q.at[i, 'score'] = (1.0 if score is None else score) if key else 0.0
+
+    # Нечеткие уровни выполняются только после точных совпадений во всем справочнике
+    use_roster = roster is not None and len(roster) > 0
+    for tier in (jira_users.TIER_EXACT, jira_users.TIER_SURNAME):
+        if use_roster:
+            found_before = q['tier'].notna().sum()
+            resolve_tiers(q, roster, stats, tiers=(tier,), cache_frame=False)
+            if stats is not None: stats['roster'] += int(q['tier'].notna().sum() - found_before)
+        resolve_tiers(q, directory, stats, tiers=(tier,))
+    resolve_tiers(q, directory, stats, tiers=(jira_users.TIER_TRANSLIT, jira_users.TIER_FUZZY, jira_users.TIER_TRIGRAM))
+
+    if stats is not None:
+        for tier in q['tier']: stats[tier or jira_users.TIER_MISS] += 1
+    fresh = q[q['tier'] != 'cache']
+    storage.save_name_resolutions(
+        {name: (key, score) for name, key, score in zip(fresh['name'], fresh['jira_key'], fresh['score'])},
+        directory.fingerprint
+    )
+    return result.merge(q, on='name', how='left')
+
+def cached_match_valid(name, key, directory, roster=None):
+    """
+    Сопоставление из кэша еще верно: пользователь key есть в справочнике и подходит к ФИО по правилам v3
+    (или по транслитерации), у ФИО нет точного совпадения с другим пользователем, а если key не
+    в составах команд (roster) — там нет участника, подходящего на уровнях exact или surname.
+    """
+    user = directory.key_map.get(key)
+    parsed = jira_users.parse_name(name)
+    if user is None or not parsed[1]: return False
+    if not (jira_users.match_user(user, parsed) or jira_users.match_user_translit(user, jira_users.translit_parsed(parsed))): return False
+    exact = directory.find_exact(name)
+    if exact is not None and exact.key != key: return False
+    if roster is not None and len(roster) and key not in roster.key_map:
+        if roster.find_exact(name) or roster.find_surname(parsed): return False
+    return True
+
+ALL_TIERS = (jira_users.TIER_EXACT, jira_users.TIER_SURNAME, jira_users.TIER_TRANSLIT, jira_users.TIER_FUZZY, jira_users.TIER_TRIGRAM)
+
+def resolve_tiers(q, directory, stats=None, tiers=ALL_TIERS, cache_frame=True):
+    """
+    Проходит уровни tiers (по порядку exact → surname → translit → fuzzy → trigram) по справочнику
+    directory для строк q (name, jira_key, tier, score), у которых tier еще не заполнен.
+    """
+    def set_tier(found, tier, scores=None):
+        idx = q['tier'].isna() & q['name'].isin(list(found))
+        q.loc[idx, 'jira_key'] = q.loc[idx, 'name'].map(found)
+        q.loc[idx, 'tier'] = tier
+        q.loc[idx, 'score'] = q.loc[idx, 'name'].map(scores) if scores else 1.0
+
+    # 1. exact
+    if jira_users.TIER_EXACT in tiers:
+        todo = q.loc[q['tier'].isna(), 'name']
+        exact = {n: u.key for n, u in zip(todo, todo.map(directory.find_exact)) if u}
+        set_tier(exact, jira_users.TIER_EXACT)
+
+    todo = q.loc[q['tier'].isna(), 'name']
+    parsed = pd.DataFrame([(n,) + jira_users.parse_name(n) for n in todo], columns=['name', 'e_parts', 'e_long', 'initial'], dtype=object)
+    parsed = parsed[parsed['e_long'].map(len) > 0]
+    if parsed.empty: return
+
+    # 2. surname
+    if jira_users.TIER_SURNAME in tiers:
+        parsed['surname'] = parsed['e_long'].str[0]
+        found, pairs = match_by_surname_frame(directory, parsed, cache_frame)
+        if stats is not None: stats['checks'] += pairs
+        set_tier(found, jira_users.TIER_SURNAME)
+
+    # 3-5. translit, fuzzy и trigram — только для оставшихся имен, по одному (поиск по индексам)
+    translit, fuzzy, trigram, trigram_scores = {}, {}, {}, {}
+    resolved = set(q.loc[q['tier'].notna(), 'name'])
+    for row in parsed.itertuples(index=False):
+        if row.name in resolved: continue
+        name_parts = (row.e_parts, row.e_long, row.initial)
+        user = directory.find_translit(name_parts, stats) if jira_users.TIER_TRANSLIT in tiers else None
+        if user:
+            translit[row.name] = user.key
+            continue
+        user = directory.find_fuzzy(name_parts, stats) if jira_users.TIER_FUZZY in tiers else None
+        if user:
+            fuzzy[row.name] = user.key
+            continue
+        if jira_users.TIER_TRIGRAM not in tiers: continue
+        user, score = directory.find_trigram(name_parts, stats)
+        if user: trigram[row.name], trigram_scores[row.name] = user.key, score
+    set_tier(translit, jira_users.TIER_TRANSLIT)
+    set_tier(fuzzy, jira_users.TIER_FUZZY)
+    set_tier(trigram, jira_users.TIER_TRIGRAM, trigram_scores)
 
 def extract_period_from_excel(df_head):
     dates = []
@@ -223,9 +1031,12 @@ def worker_process_file(file_id, channel_id, root_id):
     def update_status_text(text):
         if status_post_id: update_progress_message(status_post_id, channel_id, text)
 
+    # Справочник фиксируется на всю задачу: фоновое обновление подменяет только глобальную ссылку
+    directory = JIRA_DIRECTORY
+
     try:
         # 1. СКАЧИВАНИЕ ФАЙЛА
-        raw_file_resp = requests.get(f"{MM_SCHEME}://{MM_URL}/api/v4/files/{file_id}", headers={"Authorization": f"Bearer {MM_TOKEN}"}, verify=VERIFY_SSL, timeout=60)
+        raw_file_resp = MM_SESSION.get(f"{MM_SCHEME}://{MM_URL}/api/v4/files/{file_id}")
         if raw_file_resp.status_code != 200: return
         file_bytes = io.BytesIO(raw_file_resp.content)
 
@@ -245,6 +1056,11 @@ def worker_process_file(file_id, channel_id, root_id):
             update_status_text("⚠️ Не найден период дат.")
             return
 
+        # Составы команд Tempo загружаются в фоне, пока разбирается Excel: по ним сужается поиск сотрудников
+        teams_pool = ThreadPoolExecutor(max_workers=1)
+        teams_future = teams_pool.submit(get_tempo_teams, start_date, end_date)
+        teams_pool.shutdown(wait=False)
+
         # 2. ПАРСИНГ EXCEL
         header_row_idx = None
         name_col_idx = None
@@ -285,7 +1101,7 @@ def worker_process_file(file_id, channel_id, root_id):
 
         excel_data = []
         target_jira_keys = set()
-        unique_users = {v['key']: v for v in JIRA_LOOKUP_CACHE.values()}.values()
+        match_stats = Counter()
 
         for i in range(header_row_idx + 1, len(df_raw)):
             row = df_raw.iloc[i]
@@ -311,13 +1127,28 @@ def worker_process_file(file_id, channel_id, root_id):
                         if s and not s.isdigit() and len(s) < 5 and s.upper() != 'Я': absences.add(s)
 
             if hours > 0 or absences:
-                found_u = next((u for u in unique_users if check_name_match(u['displayName'], clean_name)), None)
-                if found_u: target_jira_keys.add(found_u['key'])
-                excel_data.append({"name_1c": clean_name, "hours_1c": hours, "jira_user": found_u, "absences": sorted(list(absences))})
+                excel_data.append({"name_1c": clean_name, "hours_1c": hours, "jira_user": None, "absences": sorted(list(absences))})
+
+        # 3. ПОЛУЧЕНИЕ ДАННЫХ (сначала ищем среди участников команд Tempo за период, затем во всем справочнике)
+        update_status_text("⏳ Сопоставляю сотрудников и определяю команды...")
+        teams_info = teams_future.result()
+        team_mapping = team_assignments(teams_info)
+        roster = directory.subset(team_mapping.keys())
+        resolved = resolve_names([r['name_1c'] for r in excel_data], directory, match_stats, roster)
+        for r, key, score in zip(excel_data, resolved['jira_key'], resolved['score']):
+            r['jira_user'] = directory.key_map.get(key) if isinstance(key, str) else None
+            r['match_score'] = score if r['jira_user'] else None
 
-        # 3. ПОЛУЧЕНИЕ ДАННЫХ
-        update_status_text("⏳ Определяю команды...")
-        team_mapping = get_tempo_teams_assignments(start_date, end_date)
+        # Не найденных в справочнике ищем в Jira точечно (новые сотрудники после загрузки справочника)
+        missing = [r['name_1c'] for r in excel_data if not r['jira_user']]
+        if missing:
+            found_online = lookup_missing_users(missing, match_stats)
+            for r in excel_data:
+                hit = None if r['jira_user'] else found_online.get(jira_users.normalize_name(r['name_1c']))
+                if hit: r['jira_user'], r['match_score'] = hit
+        for r in excel_data:
+            if r['jira_user']: target_jira_keys.add(r['jira_user'].key)
+        print(f"[MATCH] roster={match_stats['roster']}/{len(roster)} cache={match_stats['cache']} exact={match_stats['exact']} surname={match_stats['surname']} translit={match_stats['translit']} fuzzy={match_stats['fuzzy']} trigram={match_stats['trigram']} miss={match_stats['miss']} lookup={match_stats['lookup']}/{match_stats['lookup_requests']} (проверок кандидатов: {match_stats['checks']})", flush=True)
 
         # --- ЗАГРУЗКА ЛИДОВ ИЗ CONFLUENCE ---
         leads_mapping = {}
@@ -326,12 +1157,14 @@ def worker_process_file(file_id, channel_id, root_id):
             leads_mapping = teams.fetch_team_leads_mapping()
 
         tempo_agg = {}
+        tempo_incomplete = set()
         if target_jira_keys:
             def pc(c, t): update_status_text(f"⏳ Tempo... {int(c/t*100)}%")
-            logs = fetch_tempo_worklogs_for_users(start_date, end_date, list(target_jira_keys), pc)
-            for l in logs:
-                wid = l.get('worker')
-                tempo_agg[wid] = tempo_agg.get(wid, 0) + l.get('timeSpentSeconds', 0)
+            # Tempo может указывать в ворклогах логин вместо ключа
+            worker_aliases = {r['jira_user'].login: r['jira_user'].key for r in excel_data if r['jira_user'] and r['jira_user'].login}
+            tempo_agg, tempo_incomplete, worker_teams = get_tempo_worker_totals(start_date, end_date, sorted(target_jira_keys), pc, teams_info, worker_aliases)
+            # Команда по ворклогам из запросов по командам; для остальных — по составам команд
+            team_mapping.update(worker_teams)
 
         # 4. СБОРКА РЕЗУЛЬТАТА
         update_status_text("⏳ Формирую отчет...")
@@ -341,10 +1174,9 @@ def worker_process_file(file_id, channel_id, root_id):
             j_name, j_key, t_name = "—", "—", "Other"
 
             if r['jira_user']:
-                j_name = r['jira_user']['displayName']
-                j_key = r['jira_user']['key']
-                j_login = r['jira_user']['login']
-                t_sec = tempo_agg.get(j_key) or tempo_agg.get(j_login) or 0
+                j_name = r['jira_user'].display_name
+                j_key = r['jira_user'].key
+                t_sec = tempo_agg.get(j_key, 0)
                 if j_key in team_mapping: t_name = team_mapping[j_key]
 
             t_hours = round(t_sec / 3600, 2)
@@ -352,11 +1184,16 @@ def worker_process_file(file_id, channel_id, root_id):
 
             status = "✅ OK"
             if abs(diff) > 4: status = "⚠️ Расхождение"
+            if j_key in tempo_incomplete:
+                # Часы Tempo получены не полностью — разница была бы ложной
+                diff = None
+                status = "⏳ Неполные данные Tempo"
             if j_name == "—": status = "❓ Не найден в Jira"
+            elif r['match_score'] < MATCH_LOW_CONFIDENCE: status += " 🔍 Проверить ФИО"
 
             report_rows.append({
                 "Team": t_name, "Сотрудник (1C)": r['name_1c'], "Сотрудник (Jira)": j_name,
-                "Jira Key": j_key, "Link": f"https://{JIRA_DOMAIN}/secure/Tempo.jspa#/my-work/timesheet?worker={j_key}&viewType=TIMESHEET" if j_key != "—" else None,
+                "Jira Key": j_key, "Сходство ФИО": r['match_score'], "Link": f"https://{JIRA_DOMAIN}/secure/Tempo.jspa#/my-work/timesheet?worker={j_key}&viewType=TIMESHEET" if j_key != "—" else None,
                 "Часы 1С": r['hours_1c'], "Неявки (1С)": ", ".join(r['absences']), "Часы Tempo": t_hours,
                 "Разница": diff, "Статус": status
             })
@@ -397,6 +1234,8 @@ def worker_process_file(file_id, channel_id, root_id):
             ":bangbang:  - см табель", 
             "🔻  -  1C > Tempo"
         ]
+        if tempo_incomplete:
+            legend_lines.insert(2, f"⏳ Tempo ответил не полностью для {len(tempo_incomplete)} сотрудников — повторите сверку, догрузятся только недостающие дни")
         
         up_file = driver.files.upload_file(channel_id=channel_id, files={'files': ('report.xlsx', output)})
         driver.posts.delete_post(status_post_id)
@@ -464,6 +1303,7 @@ def worker_process_file(file_id, channel_id, root_id):
                 })
 
         print("[THREAD] Готово!", flush=True)
+        http_session.log_reuse_stats()
 
     except Exception as e:
         print(f"[THREAD] Error: {e}", flush=True)
@@ -491,7 +1331,14 @@ if __name__ == "__main__":
     print(f"🚀 Запуск (v5.5 Name Match Pro) для {MM_URL}...", flush=True)
     driver = Driver({'url': MM_URL, 'token': MM_TOKEN, 'scheme': MM_SCHEME, 'port': MM_PORT, 'verify': VERIFY_SSL})
     try:
-        JIRA_LOOKUP_CACHE, JIRA_KEY_CACHE = get_all_jira_users()
+        started = time.time()
+        snapshot = jira_users.load_snapshot(JIRA_SNAPSHOT_PATH)
+        if snapshot is not None:
+            JIRA_DIRECTORY = snapshot
+            print(f"⚡ Справочник из снимка: {len(snapshot)} пользователей за {int((time.time() - started) * 1000)} мс. Обновляю из Jira в фоне...", flush=True)
+        else:
+            refresh_jira_directory()
+        threading.Thread(target=directory_refresh_loop, args=(snapshot is not None,), daemon=True).start()
         driver.login()
         driver.init_websocket(my_event_handler)
     except Exception as e:
@@ -0,0 +1,60 @@
+# Общие HTTP-сессии с пулом keep-alive соединений для REST-запросов бота
+import threading
+from http.cookiejar import DefaultCookiePolicy
+import requests
+from requests.adapters import HTTPAdapter
+
+class PooledSession(requests.Session):
+    """
+    requests.Session с пулом соединений заданного размера и таймаутом по умолчанию.
+    Одна сессия на сервис используется всеми потоками: соединения (TCP + TLS)
+    переиспользуются между запросами вместо нового рукопожатия на каждый вызов.
+    """
+    def __init__(self, name, headers=None, verify=True, pool_size=10, timeout=(10, 30)):
+        super().__init__()
+        self.name = name
+        self.default_timeout = timeout
+        self.verify = verify
+        if headers: self.headers.update(headers)
+        # Авторизация задается заголовками; cookies из ответов не сохраняем, чтобы запросы
+        # из разных потоков не меняли общее состояние сессии
+        self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None: kwargs["timeout"] = self.default_timeout
+        return super().request(method, url, **kwargs)
+
+    def reuse_stats(self):
+        """
+        Статистика по хостам: {host: (запросов, открыто соединений)}.
+        Запросы сверх числа соединений обслужены уже открытыми соединениями без рукопожатия.
+        """
+        stats = {}
+        for adapter in set(self.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None: continue
+                requests_count, connections = stats.get(pool.host, (0, 0))
+                stats[pool.host] = (requests_count + pool.num_requests, connections + pool.num_connections)
+        return stats
+
+_SESSIONS = []
+_SESSIONS_LOCK = threading.Lock()
+
+def create_session(name, headers=None, verify=True, pool_size=10, timeout=(10, 30)):
+    session = PooledSession(name, headers, verify, pool_size, timeout)
+    with _SESSIONS_LOCK: _SESSIONS.append(session)
+    return session
+
+def log_reuse_stats():
+    """Печатает, сколько запросов каждая сессия обслужила переиспользованными соединениями."""
+    with _SESSIONS_LOCK: sessions = list(_SESSIONS)
+    for session in sessions:
+        for host, (requests_count, connections) in sorted(session.reuse_stats().items()):
+            if not requests_count: continue
+            reused = max(requests_count - connections, 0)
+            print(f"[HTTP] {session.name} {host}: запросов {requests_count}, соединений {connections}, переиспользовано {reused} ({reused * 100 // requests_count}%)", flush=True)
@@ -0,0 +1,438 @@
+# Справочник пользователей Jira: нормализация имен и сопоставление с ФИО из 1С
+import hashlib
+import mmap
+import os
+import pickle
+import re
+
+def split_name(name):
+    """
+    Разбивает имя на токены так же, как это делает check_name_match:
+    нижний регистр, "ё" как "е", точки и дефисы заменяются пробелами.
+    """
+    if not name: return []
+    clean = str(name).lower().replace('ё', 'е').replace('.', ' ').replace('-', ' ').strip()
+    return [p for p in clean.split() if p]
+
+def normalize_name(name):
+    """ФИО в нижнем регистре с одиночными пробелами и "е" вместо "ё" — ключ для точного поиска и кэша."""
+    return ' '.join(str(name or '').lower().replace('ё', 'е').split())
+
+def parse_name(excel_name):
+    """
+    Разбирает ФИО из 1С один раз на строку табеля.
+    Возвращает (все слова, длинные слова, первый инициал или None).
+    """
+    e_parts = split_name(excel_name)
+    e_long = [p for p in e_parts if len(p) > 1]
+    e_initials = [p for p in e_parts if len(p) == 1]
+    return e_parts, e_long, (e_initials[0] if e_initials else None)
+
+# --- ТРАНСЛИТЕРАЦИЯ ---
+# Кириллица -> латиница (ICAO/ГОСТ 52535.1-2006, плюс буквы казахского и киргизского алфавитов)
+CYR_TO_LAT = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'shch',
+    'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'iu', 'я': 'ia',
+    'ә': 'a', 'ғ': 'g', 'қ': 'k', 'ң': 'n', 'ө': 'o', 'ұ': 'u', 'ү': 'u', 'һ': 'h', 'і': 'i',
+}
+
+# Сведение распространенных вариантов латинского написания к одному ключу
+# (Yuriy/Iurii, Khan/Han, Zhukov/Jukov, Alexey/Aleksei...). Применяется за один проход
+# регулярным выражением: результат одной замены не участвует в следующей, поэтому ж/дж
+# не сливаются с и/й/ю. Одиночная j — это "ж" (Jukov), а не "й".
+LATIN_FOLDS = {
+    'dzh': 'dzh', 'dj': 'dzh', 'zh': 'zh', 'j': 'zh', 'kh': 'h', 'x': 'ks', 'tz': 'ts', 'w': 'v',
+    'yu': 'iu', 'ya': 'ia', 'yo': 'e', 'ye': 'e', 'y': 'i',
+}
+LATIN_FOLDS_RE = re.compile('|'.join(sorted(LATIN_FOLDS, key=len, reverse=True)))
+REPEATED_I_RE = re.compile('i{2,}')
+
+def translit_key(token):
+    """
+    Ключ слова, не зависящий от алфавита: "Иванов", "Ivanov" и "Iwanow" дают одно и то же.
+
+    >>> [translit_key(a) == translit_key(b) for a, b in [('Yuriy', 'Iurii'), ('Юрий', 'Yuriy'), ('Zhukov', 'Jukov'), ('Жуков', 'Zhukov'), ('Khan', 'Han'), ('Хан', 'Khan')]]
+    [True, True, True, True, True, True]
+    >>> [translit_key(a) == translit_key(b) for a, b in [('Жуков', 'Юков'), ('Zhukov', 'Yukov'), ('Жанна', 'Янна'), ('Джон', 'Ён')]]
+    [False, False, False, False]
+    >>> translit_key('Джон'), translit_key('Жуков'), translit_key('Юков')
+    ('dzhon', 'zhukov', 'iukov')
+    """
+    key = ''.join(CYR_TO_LAT.get(ch, ch) for ch in str(token).lower())
+    key = LATIN_FOLDS_RE.sub(lambda m: LATIN_FOLDS[m.group(0)], key)
+    return REPEATED_I_RE.sub('i', key)
+
+class JiraUser:
+    """
+    Неизменяемая запись справочника. displayName разбирается один раз
+    при загрузке: слова, длинные слова, первые буквы слов и ключи транслитерации слов.
+    """
+    __slots__ = ('login', 'key', 'display_name', 'tokens', 'long_tokens', 'initials', 'latin_tokens', 'latin_long', 'latin_initials')
+
+    def __init__(self, login, key, display_name):
+        tokens = tuple(split_name(display_name))
+        object.__setattr__(self, 'login', login)
+        object.__setattr__(self, 'key', key)
+        object.__setattr__(self, 'display_name', display_name)
+        object.__setattr__(self, 'tokens', tokens)
+        object.__setattr__(self, 'long_tokens', frozenset(p for p in tokens if len(p) > 1))
+        object.__setattr__(self, 'initials', frozenset(p[0] for p in tokens))
+        latin_tokens = tuple(translit_key(p) for p in tokens)
+        object.__setattr__(self, 'latin_tokens', latin_tokens)
+        object.__setattr__(self, 'latin_long', frozenset(l for p, l in zip(tokens, latin_tokens) if len(p) > 1))
+        object.__setattr__(self, 'latin_initials', frozenset(l[0] for l in latin_tokens if l))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("JiraUser is immutable")
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        return f"JiraUser({self.key!r}, {self.display_name!r})"
+
+# --- ФУНКЦИЯ СОПОСТАВЛЕНИЯ ИМЕН (v3 - поддержка "уулу") ---
+def match_user(user, parsed_name):
+    """Правила v3 для уже разобранных записи Jira и ФИО из 1С (см. parse_name)."""
+    return match_tokens(user.tokens, user.long_tokens, user.initials, parsed_name)
+
+def translit_parsed(parsed_name):
+    """Разобранное ФИО из 1С (см. parse_name) в ключах транслитерации."""
+    e_parts, e_long, first_initial = parsed_name
+    return (
+        [translit_key(p) for p in e_parts],
+        [translit_key(p) for p in e_long],
+        translit_key(first_initial) if first_initial else None,
+    )
+
+def match_user_translit(user, parsed_latin):
+    """Правила v3 на ключах транслитерации: "Иванов И.И." совпадает с "Ivanov Ivan"."""
+    return match_tokens(user.latin_tokens, user.latin_long, user.latin_initials, parsed_latin)
+
+def match_tokens(j_parts, j_long, j_initials, parsed_name):
+    e_parts, e_long, first_initial = parsed_name
+    if not j_parts or not e_parts: return False
+
+    if not e_long: return False # В 1С нет фамилии, пропускаем
+
+    # 1. Главная фамилия из 1С (первое слово) ДОЛЖНА быть в учетке Jira
+    if e_long[0] not in j_long:
+        return False
+
+    # 2. Достаем инициалы из 1С (одиночные буквы)
+    if first_initial is None:
+        return True # Если нет инициала, а основная фамилия совпала — прощаем
+
+    # 3. Находим все общие длинные слова (фамилия + возможные уулу/кызы/оглы)
+    common_long = j_long.intersection(e_long)
+
+    # 4. Проверяем оставшиеся слова в учетке Jira (это должно быть имя/отчество)
+    j_leftovers = [p for p in j_parts if p not in common_long]
+    if not j_leftovers:
+        return True # В Jira указана только фамилия без имени, считаем совпадением
+
+    # Проверяем, начинается ли хотя бы одно из оставшихся слов в Jira на первый инициал из 1С
+    if first_initial[0] not in j_initials: return False
+    return any(p.startswith(first_initial) for p in j_leftovers)
+
+def check_name_match(jira_name, excel_name):
+    if not jira_name or not excel_name: return False
+    return match_user(JiraUser(None, None, jira_name), parse_name(excel_name))
+
+def name_permutations(excel_name):
+    """
+    Варианты полного ФИО из 1С для точного поиска по lookup_map:
+    "Фамилия Имя Отчество", "Фамилия Имя", "Имя Фамилия", "Имя Отчество Фамилия".
+    ФИО с инициалами не переставляются — для них точного совпадения не бывает.
+    """
+    parts = normalize_name(excel_name).split()
+    if not 2 <= len(parts) <= 3 or any(len(p) < 2 or '.' in p for p in parts): return []
+    if len(parts) == 2:
+        return [f"{parts[0]} {parts[1]}", f"{parts[1]} {parts[0]}"]
+    surname, name, patronymic = parts
+    return [f"{surname} {name} {patronymic}", f"{surname} {name}", f"{name} {surname}", f"{name} {patronymic} {surname}"]
+
+# --- СПРАВОЧНИК ---
+# Уровни поиска пользователя (см. UserDirectory.resolve)
+TIER_EXACT = 'exact'
+TIER_SURNAME = 'surname'
+TIER_TRANSLIT = 'translit'
+TIER_FUZZY = 'fuzzy'
+TIER_TRIGRAM = 'trigram'
+TIER_MISS = 'miss'
+
+# Части тюркских отчеств, которые не могут быть фамилией сами по себе
+PATRONYMIC_PARTS = {'уулу', 'кызы', 'оглы', 'улы'}
+
+# Нечеткий поиск по триграммам: сколько фамилий-кандидатов проверять, минимальное
+# сходство и бюджет просматриваемых записей индекса на один запрос
+TRIGRAM_TOP_K = 5
+TRIGRAM_MIN_SCORE = 0.7
+TRIGRAM_MAX_POSTINGS = 5000
+
+class UserDirectory:
+    """
+    Таблица пользователей Jira, которая строится один раз при загрузке
+    и дальше только читается всеми задачами без копирования.
+    """
+    __slots__ = ('users', 'lookup_map', 'key_map', 'surname_index', 'translit_index', 'trigram_index', 'fingerprint')
+
+    def __init__(self, raw_users=()):
+        users = []
+        for u in raw_users:
+            login = u.get('name')
+            key = u.get('key')
+            d_name = u.get('displayName')
+            if not key: key = login
+            if not key: continue
+            users.append(JiraUser(login, key, d_name))
+        self._build(users)
+
+    def subset(self, keys):
+        """
+        Справочник только из пользователей с ключами keys (например, участники команд Tempo).
+        Записи JiraUser переиспользуются, заново строятся только индексы.
+        """
+        keys = set(keys)
+        directory = UserDirectory.__new__(UserDirectory)
+        directory._build([u for u in self.users if u.key in keys])
+        return directory
+
+    def _build(self, users):
+        key_map = {}
+        for user_obj in users:
+            key_map[user_obj.key] = user_obj
+        self.users = tuple(key_map.values())
+
+        # Среди тезок побеждает первый по порядку справочника — как на уровнях surname и v3
+        lookup_map = {}
+        for user_obj in self.users:
+            d_name = normalize_name(user_obj.display_name)
+            if d_name:
+                lookup_map.setdefault(d_name, user_obj)
+                parts = d_name.split()
+                if len(parts) == 2:
+                    lookup_map.setdefault(f"{parts[1]} {parts[0]}", user_obj)
+            if user_obj.login: lookup_map.setdefault(normalize_name(user_obj.login), user_obj)
+
+        self.lookup_map = lookup_map
+        self.key_map = key_map
+        self.surname_index = build_surname_index(self.users)
+        self.translit_index = build_translit_index(self.users)
+        self.trigram_index = build_trigram_index(self.translit_index)
+        self.fingerprint = directory_fingerprint(self.users)
+
+    def __len__(self):
+        return len(self.users)
+
+    def resolve(self, excel_name, stats=None):
+        """
+        Многоуровневый поиск пользователя для ФИО из 1С.
+        Возвращает (JiraUser или None, уровень, уверенность от 0 до 1).
+        1. exact   — точное совпадение нормализованного ФИО и его перестановок с lookup_map;
+        2. surname — правила v3 только для кандидатов с главной фамилией из 1С;
+        3. translit — то же по ключам транслитерации (латиница/кириллица);
+        4. fuzzy   — то же, но фамилией по очереди считается каждое следующее длинное слово;
+        5. trigram — опечатки в фамилии: top-k похожих фамилий по триграммам (см. find_trigram).
+        Уверенность меньше 1 только у trigram — это сходство фамилий.
+        stats (Counter) накапливает попадания по уровням и число проверок кандидатов.
+        """
+        user, tier, score = self._resolve(excel_name, stats)
+        if stats is not None: stats[tier or TIER_MISS] += 1
+        return user, tier, score
+
+    def _resolve(self, excel_name, stats):
+        user = self.find_exact(excel_name)
+        if user: return user, TIER_EXACT, 1.0
+
+        parsed = parse_name(excel_name)
+        if not parsed[1]: return None, None, 0.0
+
+        user = self.find_surname(parsed, stats)
+        if user: return user, TIER_SURNAME, 1.0
+
+        user = self.find_translit(parsed, stats)
+        if user: return user, TIER_TRANSLIT, 1.0
+
+        user = self.find_fuzzy(parsed, stats)
+        if user: return user, TIER_FUZZY, 1.0
+
+        user, score = self.find_trigram(parsed, stats)
+        if user: return user, TIER_TRIGRAM, score
+        return None, None, 0.0
+
+    def find_exact(self, excel_name):
+        """Уровень exact: ФИО из 1С или его перестановка целиком есть в lookup_map."""
+        for variant in name_permutations(excel_name):
+            user = self.lookup_map.get(variant)
+            if user: return user
+        return None
+
+    def find_surname(self, parsed, stats=None):
+        """Уровень surname: правила v3 для кандидатов с главной фамилией из 1С."""
+        return self._match_candidates(parsed[1][0], parsed, stats)
+
+    def find_translit(self, parsed, stats=None):
+        """Уровень translit: кандидаты по ключу транслитерации главной фамилии из 1С."""
+        parsed_latin = translit_parsed(parsed)
+        candidates = self.translit_index.get(parsed_latin[1][0], ())
+        for checks, u in enumerate(candidates, 1):
+            if match_user_translit(u, parsed_latin):
+                if stats is not None: stats['checks'] += checks
+                return u
+        if stats is not None: stats['checks'] += len(candidates)
+        return None
+
+    def find_fuzzy(self, parsed, stats=None):
+        """
+        Уровень fuzzy: фамилией по очереди считается каждое следующее длинное слово из 1С.
+        Главная фамилия из 1С тоже должна быть среди слов учетки, иначе
+        "Смирнов Иван Сергеевич" совпал бы с любым "... Иван".
+        """
+        e_parts, e_long, first_initial = parsed
+        for i, surname in enumerate(e_long[1:], 1):
+            if surname in PATRONYMIC_PARTS: continue
+            rotated = (e_parts, [surname] + e_long[:i] + e_long[i + 1:], first_initial)
+            user = self._match_candidates(surname, rotated, stats, also=e_long[0])
+            if user: return user
+        return None
+
+    def find_trigram(self, parsed, stats=None):
+        """
+        Уровень trigram: ищет фамилии справочника, похожие на главную фамилию из 1С
+        ("Иваноов" -> "Иванов"), и проверяет их владельцев по правилам v3.
+        Стоимость ограничена: просматриваются сначала самые редкие триграммы и не более
+        TRIGRAM_MAX_POSTINGS записей индекса, проверяются только TRIGRAM_TOP_K фамилий.
+        Возвращает (JiraUser или None, сходство фамилий по Дайсу).
+        """
+        e_parts, e_long, first_initial = translit_parsed(parsed)
+        query = e_long[0]
+        grams = trigrams(query)
+        if not grams: return None, 0.0
+
+        postings = sorted((self.trigram_index.get(g, ()) for g in grams), key=len)
+        shared = {}
+        budget = TRIGRAM_MAX_POSTINGS
+        for bucket in postings:
+            if budget <= 0: break
+            for token in bucket[:budget]:
+                shared[token] = shared.get(token, 0) + 1
+            budget -= len(bucket)
+        if stats is not None: stats['trigram_postings'] += TRIGRAM_MAX_POSTINGS - max(budget, 0)
+
+        scored = []
+        for token, common in shared.items():
+            if token == query: continue
+            score = 2.0 * common / (len(grams) + len(trigrams(token)))
+            if score >= TRIGRAM_MIN_SCORE: scored.append((score, token))
+        scored.sort(key=lambda x: (-x[0], x[1]))
+
+        for score, token in scored[:TRIGRAM_TOP_K]:
+            variant = (e_parts, [token] + e_long[1:], first_initial)
+            for u in self.translit_index.get(token, ()):
+                if stats is not None: stats['checks'] += 1
+                if match_user_translit(u, variant): return u, round(score, 2)
+        return None, 0.0
+
+    def _match_candidates(self, surname, parsed, stats, also=None):
+        """Первый кандидат с длинным словом surname (и also, если задано), подходящий по правилам v3."""
+        candidates = self.surname_index.get(surname, ())
+        for checks, u in enumerate(candidates, 1):
+            if (also is None or also in u.long_tokens) and match_user(u, parsed):
+                if stats is not None: stats['checks'] += checks
+                return u
+        if stats is not None: stats['checks'] += len(candidates)
+        return None
+
+# Версия правил сопоставления: входит в отпечаток справочника, чтобы после изменения
+# правил кэш сопоставлений прошлых запусков не использовался
+MATCH_RULES_VERSION = 5
+
+def directory_fingerprint(users):
+    """
+    Отпечаток справочника: меняется при любом изменении key/login/displayName,
+    порядка пользователей (от порядка зависит выбор среди однофамильцев) или правил сопоставления.
+    """
+    digest = hashlib.sha1(f"rules{MATCH_RULES_VERSION}\x1e".encode('utf-8'))
+    for u in users:
+        digest.update(f"{u.key}\x1f{u.login}\x1f{u.display_name}\x1e".encode('utf-8'))
+    return digest.hexdigest()
+
+# --- ИНДЕКС ПО ФАМИЛИЯМ ---
+def build_surname_index(users):
+    """
+    Строит обратный индекс {длинное слово из displayName: (пользователи)}.
+    Ключами становятся фамилии, имена и части вроде "уулу/кызы/оглы".
+    Порядок пользователей совпадает с порядком справочника.
+    """
+    index = {}
+    for u in users:
+        for token in u.long_tokens:
+            index.setdefault(token, []).append(u)
+    return {token: tuple(bucket) for token, bucket in index.items()}
+
+def build_translit_index(users):
+    """Тот же индекс, но по ключам транслитерации длинных слов (см. translit_key)."""
+    index = {}
+    for u in users:
+        for key in u.latin_long:
+            if not key: continue
+            index.setdefault(key, []).append(u)
+    return {key: tuple(bucket) for key, bucket in index.items()}
+
+# --- ТРИГРАММЫ ---
+def trigrams(key):
+    """Множество триграмм слова с маркерами начала и конца: "ivan" -> {"$iv", "iva", "van", "an$"}."""
+    padded = f"${key}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def build_trigram_index(translit_index):
+    """Обратный индекс {триграмма: (ключи транслитерации фамилий)} для нечеткого поиска."""
+    index = {}
+    for key in translit_index:
+        for gram in trigrams(key):
+            index.setdefault(gram, []).append(key)
+    return {gram: tuple(keys) for gram, keys in index.items()}
+
+# --- СНИМОК СПРАВОЧНИКА НА ДИСКЕ ---
+# Версия формата: снимки других версий игнорируются (меняется при изменении JiraUser/индексов)
+SNAPSHOT_VERSION = 3
+
+def save_snapshot(directory, path):
+    """
+    Сохраняет справочник вместе с lookup_map, key_map и индексами (pickle).
+    Запись атомарная: сначала во временный файл, затем замена.
+    """
+    snapshot_dir = os.path.dirname(path)
+    if snapshot_dir: os.makedirs(snapshot_dir, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump((SNAPSHOT_VERSION, directory), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def load_snapshot(path):
+    """
+    Загружает справочник из снимка (файл отображается в память через mmap).
+    Возвращает None, если снимка нет, он поврежден или другой версии.
+    """
+    try:
+        with open(path, 'rb') as f:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    version, directory = pickle.loads(mm)
+            except (ValueError, OSError):
+                f.seek(0)
+                version, directory = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"⚠️ Снимок справочника {path} не прочитан: {e}", flush=True)
+        return None
+    if version != SNAPSHOT_VERSION or not isinstance(directory, UserDirectory): return None
+    return directory
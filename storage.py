@@ -0,0 +1,206 @@
+# Локальное хранилище (SQLite) для данных, которые должны переживать перезапуск бота
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from datetime import date
+
+DB_PATH = os.getenv("CACHE_DB_PATH", "data/mm-1c.sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS name_matches (
+    name TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    jira_key TEXT,
+    score REAL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (name, fingerprint)
+);
+CREATE TABLE IF NOT EXISTS worklog_days (
+    worker TEXT NOT NULL,
+    day TEXT NOT NULL,
+    seconds INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (worker, day)
+);
+CREATE TABLE IF NOT EXISTS team_snapshots (
+    period_from TEXT NOT NULL,
+    period_to TEXT NOT NULL,
+    taken_at REAL NOT NULL,
+    PRIMARY KEY (period_from, period_to)
+);
+CREATE TABLE IF NOT EXISTS team_memberships (
+    period_from TEXT NOT NULL,
+    period_to TEXT NOT NULL,
+    team_pos INTEGER NOT NULL,
+    team_id,
+    team_name TEXT,
+    member_key TEXT,
+    date_from TEXT,
+    date_to TEXT
+);
+CREATE INDEX IF NOT EXISTS team_memberships_period ON team_memberships (period_from, period_to);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# Изменения схемы для баз, созданных предыдущими версиями (ошибки вроде "duplicate column" игнорируются)
+MIGRATIONS = [
+    # Кэш сопоставлений с ключом только по имени заменен таблицей name_matches
+    "DROP TABLE IF EXISTS name_resolutions",
+]
+
+# Записи кэша сопоставлений старше этого срока удаляются (отпечатки прошлых справочников и периодов)
+NAME_MATCHES_TTL = 90 * 86400
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+def connect():
+    """Открывает новое соединение (по одному на вызов — задачи работают в разных потоках)."""
+    global _schema_ready
+    db_dir = os.path.dirname(DB_PATH)
+    if db_dir: os.makedirs(db_dir, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    if not _schema_ready:
+        with _schema_lock:
+            conn.executescript(SCHEMA)
+            for statement in MIGRATIONS:
+                try: conn.execute(statement)
+                except sqlite3.OperationalError: pass
+            _schema_ready = True
+    return conn
+
+def chunked(items, size=500):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# --- КЭШ СОПОСТАВЛЕНИЯ ИМЕН 1С -> JIRA ---
+def load_name_resolutions(names, fingerprint):
+    """
+    Возвращает {нормализованное ФИО: (jira_key или None, уверенность)} для имен, которые уже
+    сопоставлялись на справочнике с тем же отпечатком. Остальные имена нужно
+    сопоставить заново (справочник изменился или имя встречается впервые).
+    """
+    result = {}
+    try:
+        with closing(connect()) as conn:
+            for part in chunked(names):
+                marks = ",".join("?" * len(part))
+                rows = conn.execute(
+                    f"SELECT name, jira_key, score FROM name_matches WHERE fingerprint = ? AND name IN ({marks})",
+                    [fingerprint] + part
+                ).fetchall()
+                result.update((name, (key, score)) for name, key, score in rows)
+    except Exception as e:
+        print(f"⚠️ Кэш сопоставлений недоступен: {e}", flush=True)
+    return result
+
+def save_name_resolutions(resolutions, fingerprint):
+    """
+    Сохраняет {нормализованное ФИО: (jira_key или None, уверенность)} для отпечатка fingerprint.
+    Записи других отпечатков (прошлых версий справочника) не затрагиваются,
+    кроме давно не обновлявшихся.
+    """
+    if not resolutions: return
+    now = time.time()
+    try:
+        with closing(connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO name_matches (name, fingerprint, jira_key, score, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [(name, fingerprint, key, float(score), now) for name, (key, score) in resolutions.items()]
+            )
+            conn.execute("DELETE FROM name_matches WHERE updated_at < ?", (now - NAME_MATCHES_TTL,))
+    except Exception as e:
+        print(f"⚠️ Не удалось сохранить кэш сопоставлений: {e}", flush=True)
+
+# --- КЭШ ЧАСОВ TEMPO ПО ДНЯМ ---
+def load_worklog_days(workers, day_from, day_to):
+    """Список (worker, день 'YYYY-MM-DD', секунд, когда получено) за дни day_from..day_to включительно."""
+    result = []
+    try:
+        with closing(connect()) as conn:
+            for part in chunked(workers):
+                marks = ",".join("?" * len(part))
+                result.extend(conn.execute(
+                    f"SELECT worker, day, seconds, fetched_at FROM worklog_days WHERE day BETWEEN ? AND ? AND worker IN ({marks})",
+                    [day_from, day_to] + part
+                ).fetchall())
+    except Exception as e:
+        print(f"⚠️ Кэш ворклогов недоступен: {e}", flush=True)
+    return result
+
+def save_worklog_days(rows):
+    """Сохраняет [(worker, день, секунд)] с текущим временем получения, заменяя прежние значения."""
+    if not rows: return
+    now = time.time()
+    try:
+        with closing(connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO worklog_days (worker, day, seconds, fetched_at) VALUES (?, ?, ?, ?)",
+                [(worker, day, int(seconds), now) for worker, day, seconds in rows]
+            )
+    except Exception as e:
+        print(f"⚠️ Не удалось сохранить кэш ворклогов: {e}", flush=True)
+
+# --- СНИМКИ СОСТАВОВ КОМАНД TEMPO ПО ПЕРИОДАМ ---
+def load_team_snapshot(period_from, period_to):
+    """
+    Снимок составов команд за период: (когда сделан, {id команды: {'name', 'members': {jira_key: (с, по)}}})
+    в порядке команд на момент снимка; (None, {}), если снимка нет.
+    """
+    try:
+        with closing(connect()) as conn:
+            row = conn.execute("SELECT taken_at FROM team_snapshots WHERE period_from = ? AND period_to = ?", (period_from, period_to)).fetchone()
+            if not row: return None, {}
+            teams_info = {}
+            for team_id, team_name, member_key, date_from, date_to in conn.execute(
+                "SELECT team_id, team_name, member_key, date_from, date_to FROM team_memberships WHERE period_from = ? AND period_to = ? ORDER BY team_pos, rowid",
+                (period_from, period_to)
+            ):
+                team = teams_info.setdefault(team_id, {"name": team_name, "members": {}})
+                if member_key: team["members"][member_key] = (date.fromisoformat(date_from), date.fromisoformat(date_to))
+            return row[0], teams_info
+    except Exception as e:
+        print(f"⚠️ Снимки составов команд недоступны: {e}", flush=True)
+        return None, {}
+
+def save_team_snapshot(period_from, period_to, teams_info):
+    """Заменяет снимок составов команд за период (команда без участников хранится строкой без member_key)."""
+    rows = []
+    for pos, (team_id, team) in enumerate(teams_info.items()):
+        rows.append((period_from, period_to, pos, team_id, team["name"], None, None, None))
+        for member_key, (date_from, date_to) in team["members"].items():
+            rows.append((period_from, period_to, pos, team_id, team["name"], member_key, date_from.isoformat(), date_to.isoformat()))
+    try:
+        with closing(connect()) as conn, conn:
+            conn.execute("DELETE FROM team_memberships WHERE period_from = ? AND period_to = ?", (period_from, period_to))
+            conn.executemany("INSERT INTO team_memberships (period_from, period_to, team_pos, team_id, team_name, member_key, date_from, date_to) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.execute("INSERT OR REPLACE INTO team_snapshots (period_from, period_to, taken_at) VALUES (?, ?, ?)", (period_from, period_to, time.time()))
+    except Exception as e:
+        print(f"⚠️ Не удалось сохранить снимок составов команд: {e}", flush=True)
+
+# --- ПОДОБРАННЫЕ ПАРАМЕТРЫ (размеры пачек и т.п.) ---
+def load_setting(name, default):
+    try:
+        with closing(connect()) as conn:
+            row = conn.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+            return row[0] if row else default
+    except Exception as e:
+        print(f"⚠️ Сохраненные настройки недоступны: {e}", flush=True)
+        return default
+
+def save_setting(name, value):
+    try:
+        with closing(connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO settings (name, value, updated_at) VALUES (?, ?, ?)",
+                (name, float(value), time.time())
+            )
+    except Exception as e:
+        print(f"⚠️ Не удалось сохранить настройку {name}: {e}", flush=True)
@@ -0,0 +1,103 @@
+# Потоковый разбор ответа /worklogs/search Tempo: ворклоги читаются по одному,
+# весь ответ (десятки МБ для тяжелых пачек) в памяти не собирается
+import codecs
+import json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+READ_SIZE = 64 * 1024
+WHITESPACE = " \t\r\n"
+
+class CountingReader:
+    """
+    Файлоподобная обертка над urllib3-ответом (resp.raw): распаковывает gzip,
+    считает прочитанные байты и позволяет заглянуть в начало ответа (peek).
+    """
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+        self._pending = b""
+
+    def read(self, size=-1):
+        if size == 0: return b""
+        pending, self._pending = self._pending, b""
+        if pending and size is not None and size > 0: return pending
+        data = self.raw.read(None if size is None or size < 0 else size, decode_content=True) or b""
+        self.bytes_read += len(data)
+        return pending + data
+
+    def peek(self):
+        """Первый значащий символ ответа ('[' или '{'), пустая строка для пустого ответа."""
+        while True:
+            data = self.read(READ_SIZE)
+            if not data: return ""
+            self._pending = data.lstrip(WHITESPACE.encode())
+            if self._pending: return chr(self._pending[0])
+
+def slim_worklog(w):
+    """Только нужные отчету поля ворклога."""
+    issue = w.get('issue')
+    return {
+        'worker': w.get('worker'),
+        'timeSpentSeconds': w.get('timeSpentSeconds', 0),
+        'dateStarted': w.get('dateStarted'),
+        'issueKey': issue.get('key') if isinstance(issue, dict) else None,
+    }
+
+def iter_worklogs(reader):
+    """
+    Ворклоги из ответа поиска по одному (только поля slim_worklog).
+    Ответ — массив ворклогов или объект с массивом в 'results'. Используется ijson, если он
+    установлен; иначе массив разбирается по одному элементу через json.JSONDecoder.raw_decode,
+    а объект (старый формат ответа) читается целиком. Ошибка формата — ValueError.
+    """
+    first = reader.peek()
+    if not first: return
+    if ijson is not None:
+        try:
+            for w in ijson.items(reader, "item" if first == "[" else "results.item", use_float=True):
+                yield slim_worklog(w)
+        except ijson.JSONError as e:
+            raise ValueError(f"некорректный JSON: {e}")
+        return
+    if first == "[":
+        for w in iter_array_items(reader):
+            yield slim_worklog(w)
+        return
+    data = json.loads(reader.read())
+    for w in data.get('results', []) if isinstance(data, dict) else data:
+        yield slim_worklog(w)
+
+def iter_array_items(reader):
+    """Элементы JSON-массива верхнего уровня по мере чтения (без внешних зависимостей)."""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf, pos = "", 0
+    started = eof = False
+    while True:
+        while pos < len(buf) and (buf[pos] in WHITESPACE or (started and buf[pos] == ",")): pos += 1
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != "[": raise ValueError("ожидался JSON-массив")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == "]": return
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+                yield item
+                continue
+            except ValueError:
+                # Элемент еще не дочитан — читаем дальше; после конца ответа это ошибка формата
+                if eof: raise
+        elif eof:
+            raise ValueError("JSON-массив оборван")
+        data = reader.read(READ_SIZE)
+        if data:
+            buf, pos = buf[pos:] + utf8.decode(data), 0
+        else:
+            eof = True
+            buf += utf8.decode(b"", final=True)
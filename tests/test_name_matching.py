@@ -0,0 +1,61 @@
+# Пакетное сопоставление (bot.resolve_names) должно давать тот же результат, что и UserDirectory.resolve
+import os
+import random
+import sys
+import tempfile
+import unittest
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+for key in ("MM_URL", "MM_TOKEN", "MM_TARGET_CHANNEL_ID", "JIRA_DOMAIN", "JIRA_TOKEN"):
+    os.environ.setdefault(key, "test")
+
+import bot
+import jira_users
+import storage
+
+SURNAMES = ["Ёлкин", "Елкин", "Семёнов", "Семенов", "Иванов", "Петров", "Сидоров", "Жуков", "Юков", "Ivanov", "Zhukov", "Асанов"]
+NAMES = ["Павел", "Пётр", "Иван", "Игорь", "Алёна", "Елена", "Азамат", "Ivan"]
+PATRONYMICS = ["Петрович", "Иванович", "Сергеевич", "уулу", ""]
+
+def random_names(rng, count):
+    names = []
+    for _ in range(count):
+        surname, name, patronymic = rng.choice(SURNAMES), rng.choice(NAMES), rng.choice(PATRONYMICS)
+        style = rng.randrange(4)
+        if style == 0: names.append(f"{surname} {name} {patronymic}".strip())
+        elif style == 1: names.append(f"{surname} {name[0]}.{patronymic[:1] + '.' if patronymic else ''}")
+        elif style == 2: names.append(f"{name} {surname}")
+        else: names.append(f"{surname}  {name.upper()}")
+    return names
+
+class ResolveParityTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        storage.DB_PATH = os.path.join(self.tmp.name, "cache.sqlite3")
+        storage._schema_ready = False
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def assert_parity(self, directory, names):
+        resolved = bot.resolve_names(names, directory, Counter())
+        for name, key in zip(resolved['name_1c'], resolved['jira_key']):
+            user = directory.resolve(name)[0]
+            self.assertEqual(key, user.key if user else None, name)
+
+    def test_yo_surnames(self):
+        directory = jira_users.UserDirectory([
+            {"key": "k1", "name": "elkin", "displayName": "Елкин Павел"},
+            {"key": "k2", "name": "yolkin", "displayName": "Ёлкин Пётр"},
+        ])
+        self.assertTrue(jira_users.check_name_match("Ёлкин Пётр", "Елкин П.П."))
+        self.assert_parity(directory, ["Ёлкин П.П.", "Елкин П.", "Ёлкин Пётр", "Пётр Ёлкин"])
+
+    def test_random_names(self):
+        rng = random.Random(5)
+        raw = [{"key": f"k{i}", "name": f"u{i}", "displayName": n} for i, n in enumerate(random_names(rng, 60)) if "." not in n]
+        self.assert_parity(jira_users.UserDirectory(raw), random_names(rng, 300))
+
+if __name__ == "__main__":
+    unittest.main()